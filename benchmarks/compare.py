@@ -0,0 +1,69 @@
+# Compare two sets of results written by suite.py, for instance for two
+# versions of the package, and report the stages whose total wall time
+# changed by more than the given fraction. Usage:
+#
+#     python benchmarks/compare.py old.json new.json [--threshold 0.1]
+#
+# The exit status is 1 if any stage got slower by more than the threshold.
+
+import sys
+import json
+from optparse import OptionParser
+
+from suite import STAGES
+
+
+def _key(case):
+    return json.dumps(case, sort_keys=True)
+
+
+def totals(filename):
+    '''
+    Return the total wall time of each stage over all generations, for each
+    case that ran, keyed by case.
+    '''
+    results = {}
+    for result in json.load(open(filename, 'rb'))['results']:
+        if 'records' not in result:
+            continue
+        stages = dict((stage, 0.) for stage in STAGES)
+        for record in result['records']:
+            stages[record['stage']] += record['wall']
+        results[_key(result['case'])] = stages
+    return results
+
+
+def main():
+
+    parser = OptionParser(usage="%prog old.json new.json [options]")
+    parser.add_option('--threshold', type='float', default=0.1,
+                      help="fractional change in wall time to report")
+
+    options, args = parser.parse_args()
+
+    if len(args) != 2:
+        parser.error("two results files are required")
+
+    old, new = totals(args[0]), totals(args[1])
+
+    slower = False
+
+    for key in sorted(set(old) & set(new)):
+        case = json.loads(key)
+        label = '%(mode)s/%(pipeline)s n_models=%(n_models)i n_params=%(n_params)i cost=%(cost)g' % case
+        for stage in STAGES:
+            if old[key][stage] <= 0.:
+                continue
+            ratio = new[key][stage] / old[key][stage]
+            if abs(ratio - 1.) > options.threshold:
+                print "%-60s %-15s %10.4f -> %10.4f (x%.2f)" % (label, stage, old[key][stage], new[key][stage], ratio)
+                if ratio > 1.:
+                    slower = True
+
+    for key in sorted(set(old) ^ set(new)):
+        print "Only in one of the results: %s" % key
+
+    sys.exit(1 if slower else 0)
+
+if __name__ == '__main__':
+    main()
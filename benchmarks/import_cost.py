@@ -0,0 +1,49 @@
+# Measure the cost of importing the package: the time taken, the peak memory
+# of the process, and which of the optional heavy dependencies are loaded.
+# Each measurement is made in a fresh interpreter, and the results are
+# printed as JSON. Usage:
+#
+#     python benchmarks/import_cost.py [n_repeats]
+
+import os
+import sys
+import json
+import subprocess
+
+MEASURE = '''
+import sys, time, json, resource
+start = time.time()
+import genetic
+elapsed = time.time() - start
+print json.dumps({'time': elapsed,
+                  'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  'modules': sorted(m for m in %r if m in sys.modules)})
+'''
+
+OPTIONAL = ['atpy', 'matplotlib', 'mpi4py', 'multiprocessing', 'subprocess']
+
+
+def measure():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = root + os.pathsep + env.get('PYTHONPATH', '')
+    output = subprocess.check_output([sys.executable, '-c', MEASURE % OPTIONAL], env=env)
+    return json.loads(output.splitlines()[-1])
+
+
+def main():
+
+    n_repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    runs = [measure() for i in range(n_repeats)]
+    times = sorted(run['time'] for run in runs)
+
+    print json.dumps({'benchmark': 'import_cost',
+                      'repeats': n_repeats,
+                      'time_min': times[0],
+                      'time_median': times[len(times) / 2],
+                      'max_rss_kb': max(run['max_rss_kb'] for run in runs),
+                      'modules_loaded': runs[-1]['modules']}, indent=2)
+
+if __name__ == '__main__':
+    main()
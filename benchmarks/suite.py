@@ -0,0 +1,396 @@
+# Benchmark suite for the stages of Genetic. Synthetic models, either free
+# or costing a fixed amount of CPU time each, are run through initialize,
+# make_par_table, make_par_indiv, compute_models, and compute_fits for every
+# combination of the values given for the mode, pipeline, number of models,
+# number of parameters, and model cost. For each stage of each generation,
+# the wall time, CPU time, peak memory, and number of files in the output
+# directory are recorded. The size of the archive read by make_par_table
+# grows with the generation, so the records for successive generations show
+# how the stages scale with the archive size.
+#
+# The peak memory of each stage (stage_peak_rss_kb) is measured on Linux by
+# resetting the high-water mark of the resident set size of the process
+# before the stage, through /proc/self/clear_refs, and reading it (VmHWM in
+# /proc/self/status) after the stage. It is null elsewhere. For the child
+# processes, only the largest peak of any child so far is available
+# (max_rss_children_kb).
+#
+# Each case runs in a fresh interpreter (under mpirun for the 'mpi' mode, if
+# mpirun and mpi4py are available), and the results are written as JSON so
+# that runs for different versions can be compared with compare.py. Usage:
+#
+#     python benchmarks/suite.py --n-models 100,1000 --n-params 4,16 \
+#         --modes serial,multiprocessing,mpi --cost 0,0.01 -o results.json
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import tempfile
+import resource
+import itertools
+import subprocess
+from optparse import OptionParser
+from distutils.spawn import find_executable
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+STAGES = ['initialize', 'make_par_table', 'make_par_indiv', 'compute_models', 'compute_fits']
+
+RESULT_MARKER = 'BENCHMARK_RESULT '
+
+# Script used as the model in serial_file mode
+MODEL_SCRIPT = '''#!%(python)s
+import sys, time
+par_file, model_dir, model_name = sys.argv[1:]
+values = [float(line.split('=')[1]) for line in open(par_file)]
+start = time.time()
+while time.time() - start < %(cost)r:
+    pass
+f = open(model_dir + model_name + '.out', 'wb')
+f.write('%%r\\n' %% sum((value - 1.) ** 2 for value in values))
+f.close()
+'''
+
+
+def parser(line):
+    return line.split('=')[0].strip(), line.split('=')[1].strip()
+
+
+class SyntheticModel(object):
+    '''
+    A model that costs cost seconds of CPU time (or nothing if cost is 0),
+    and whose chi^2 is the sum of the squared differences between the
+    parameters and 1.
+    '''
+
+    def __init__(self, cost=0.):
+        self.cost = cost
+
+    def _work(self):
+        start = time.time()
+        while time.time() - start < self.cost:
+            pass
+
+    def _write(self, values, model_dir, model_name):
+        self._work()
+        f = open(model_dir + model_name + '.out', 'wb')
+        f.write('%r\n' % sum((value - 1.) ** 2 for value in values))
+        f.close()
+
+    def run(self, par_file, model_dir, model_name):
+        self._write([float(line.split('=')[1]) for line in open(par_file)], model_dir, model_name)
+
+    def run_parameters(self, contents, model_dir, model_name):
+        self._write([float(line.split('=')[1]) for line in contents.splitlines()], model_dir, model_name)
+
+    def evaluate(self, parameters):
+        self._work()
+        return {'chi2': sum((value - 1.) ** 2 for value in parameters.values())}
+
+
+class SyntheticFitter(object):
+    '''
+    Read back the chi^2 written out by SyntheticModel, and write out the
+    fitting results in the table format given.
+    '''
+
+    def __init__(self, tables):
+        self.tables = tables
+
+    def run(self, models_dir, output_file, plots_dir):
+        from genetic import list_models
+        from genetic.tables import make_table
+        model_names, chi2 = [], []
+        for model_name, model_dir in list_models(models_dir):
+            model_names.append(model_name)
+            chi2.append(float(open(os.path.join(model_dir, model_name + '.out'), 'rb').read()))
+        self.tables.write(output_file, make_table([('model_name', model_names, '|S30'),
+                                                   ('chi2', chi2, float)]))
+
+
+def count_files(directory):
+    return sum(len(files) for path, dirs, files in os.walk(directory))
+
+
+def usage():
+    self = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {'cpu': self.ru_utime + self.ru_stime,
+            'cpu_children': children.ru_utime + children.ru_stime,
+            'max_rss_children_kb': children.ru_maxrss}
+
+
+def reset_peak_rss():
+    '''
+    Reset the high-water mark of the resident set size of the process, and
+    return whether this is supported.
+    '''
+    try:
+        f = open('/proc/self/clear_refs', 'wb')
+        f.write('5')
+        f.close()
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def peak_rss():
+    '''
+    Return the high-water mark of the resident set size of the process in
+    kB, or None if it is not available.
+    '''
+    try:
+        for line in open('/proc/self/status', 'rb'):
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def run_case(case, work_dir):
+    '''
+    Run the case given in the directory given, and return a list of records
+    for each stage of each generation. In MPI mode, the records are only
+    returned on rank 0.
+    '''
+
+    from genetic import Genetic, mpi
+    from genetic.tables import table_formats
+
+    template = os.path.join(work_dir, 'template.par')
+    configuration = os.path.join(work_dir, 'benchmark.conf')
+    output_dir = os.path.join(work_dir, 'models')
+
+    names = ['p%i' % i for i in range(case['n_params'])]
+    open(template, 'wb').write(''.join('%s = VAR\n' % name for name in names))
+    open(configuration, 'wb').write(''.join('%s linear -10 10\n' % name for name in names))
+
+    if case['mode'] == 'serial_file':
+        model = os.path.join(work_dir, 'model.py')
+        open(model, 'wb').write(MODEL_SCRIPT % {'python': sys.executable, 'cost': case['cost']})
+        os.chmod(model, 0755)
+    else:
+        model = SyntheticModel(case['cost'])
+
+    if case['pipeline'] == 'memory':
+        fitter = None
+    else:
+        fitter = SyntheticFitter(table_formats[case['table_format']]())
+
+    g = Genetic(case['n_models'], output_dir, template, configuration,
+                mode=case['mode'], n_cores=case['n_cores'], seed=0,
+                pipeline=case['pipeline'], layout=case['layout'],
+                parameter_bundle=case['parameter_bundle'],
+                table_format=case['table_format'], diagnostics=False)
+
+    master = case['mode'] != 'mpi' or mpi.rank == 0
+
+    stages = {'initialize': lambda generation: g.initialize(generation),
+              'make_par_table': lambda generation: g.make_par_table(generation),
+              'make_par_indiv': lambda generation: g.make_par_indiv(generation, parser),
+              'compute_models': lambda generation: g.compute_models(generation, model),
+              'compute_fits': lambda generation: g.compute_fits(generation, fitter)}
+
+    n_output = int(case['n_models'] * 0.1)
+
+    records = []
+
+    for generation in range(1, case['generations'] + 1):
+
+        n_files = count_files(output_dir) if master else 0
+
+        for stage in STAGES:
+
+            reset = reset_peak_rss()
+            before = usage()
+            start = time.time()
+            stages[stage](generation)
+            wall = time.time() - start
+            after = usage()
+            stage_rss = peak_rss() if reset else None
+
+            if not master:
+                continue
+
+            files = count_files(output_dir)
+
+            records.append({'generation': generation,
+                            'stage': stage,
+                            'archive_models': 0 if generation == 1 else case['n_models'] + (generation - 2) * n_output,
+                            'wall': wall,
+                            'cpu': after['cpu'] - before['cpu'],
+                            'cpu_children': after['cpu_children'] - before['cpu_children'],
+                            'stage_peak_rss_kb': stage_rss,
+                            'max_rss_children_kb': after['max_rss_children_kb'],
+                            'files': files,
+                            'files_created': files - n_files})
+
+            n_files = files
+
+    g.close()
+
+    return records if master else None
+
+
+def mpi_available():
+    if find_executable('mpirun') is None:
+        return False
+    return subprocess.call([sys.executable, '-c', 'import mpi4py'], stderr=open(os.devnull, 'wb')) == 0
+
+
+def spawn_case(case, keep=False):
+    '''
+    Run the case given in a fresh interpreter, and return the records.
+    '''
+
+    work_dir = tempfile.mkdtemp(prefix='genetic_benchmark_')
+
+    command = [sys.executable, os.path.abspath(__file__), '--case', json.dumps(case), '--work-dir', work_dir]
+    if case['mode'] == 'mpi':
+        command = ['mpirun', '-np', str(case['n_cores'] + 1)] + command
+
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE)
+        output = process.communicate()[0]
+        if process.returncode != 0:
+            return {'error': 'exit status %i' % process.returncode}
+        for line in output.splitlines():
+            if line.startswith(RESULT_MARKER):
+                return {'records': json.loads(line[len(RESULT_MARKER):])}
+        return {'error': 'no results'}
+    finally:
+        if keep:
+            print "Output of case kept in %s" % work_dir
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def metadata():
+
+    import genetic
+
+    try:
+        commit = subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stdout=subprocess.PIPE,
+                                  stderr=open(os.devnull, 'wb')).communicate()[0].strip() or None
+    except OSError:
+        commit = None
+
+    return {'version': genetic.__version__,
+            'commit': commit,
+            'python': sys.version.split()[0],
+            'numpy': np.__version__,
+            'platform': sys.platform,
+            'host': socket.gethostname(),
+            'cpus': os.sysconf('SC_NPROCESSORS_ONLN'),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def summarize(results):
+    '''
+    Print the total wall time of each stage over all generations, for each
+    case.
+    '''
+    print "%-60s" % 'case' + ''.join(['%15s' % stage for stage in STAGES])
+    for result in results:
+        case = result['case']
+        label = '%(mode)s/%(pipeline)s n_models=%(n_models)i n_params=%(n_params)i cost=%(cost)g' % case
+        if 'records' not in result:
+            print "%-60s %s" % (label, result.get('error', result.get('skipped')))
+            continue
+        totals = dict((stage, 0.) for stage in STAGES)
+        for record in result['records']:
+            totals[record['stage']] += record['wall']
+        print "%-60s" % label + ''.join(['%15.4f' % totals[stage] for stage in STAGES])
+
+
+def split(values, convert):
+    return [convert(value) for value in values.split(',')]
+
+
+def main():
+
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--modes', default='serial,multiprocessing',
+                      help="comma-separated list of modes (serial, serial_file, multiprocessing, mpi)")
+    parser.add_option('--pipelines', default='files,memory',
+                      help="comma-separated list of pipelines (files, memory)")
+    parser.add_option('--n-models', default='100,1000',
+                      help="comma-separated list of numbers of models")
+    parser.add_option('--n-params', default='4,16',
+                      help="comma-separated list of numbers of parameters")
+    parser.add_option('--cost', default='0',
+                      help="comma-separated list of CPU times for each model, in seconds")
+    parser.add_option('--generations', type='int', default=5,
+                      help="number of generations in each case")
+    parser.add_option('--n-cores', type='int', default=4,
+                      help="number of processes in multiprocessing and mpi modes")
+    parser.add_option('--layout', default='flat')
+    parser.add_option('--table-format', default='npy')
+    parser.add_option('--parameter-bundle', action='store_true', default=False)
+    parser.add_option('-o', '--output', default='benchmark_results.json',
+                      help="file to write the results to")
+    parser.add_option('--keep', action='store_true', default=False,
+                      help="keep the output directories of the cases")
+    parser.add_option('--case', help="run a single case, given as JSON (used internally)")
+    parser.add_option('--work-dir', help="directory for a single case (used internally)")
+
+    options, args = parser.parse_args()
+
+    if options.case:
+        records = run_case(json.loads(options.case), options.work_dir)
+        if records is not None:
+            print RESULT_MARKER + json.dumps(records)
+        return
+
+    has_mpi = None
+
+    results = []
+
+    for mode, pipeline, n_models, n_params, cost in itertools.product(split(options.modes, str),
+                                                                      split(options.pipelines, str),
+                                                                      split(options.n_models, int),
+                                                                      split(options.n_params, int),
+                                                                      split(options.cost, float)):
+
+        case = {'mode': mode, 'pipeline': pipeline, 'n_models': n_models,
+                'n_params': n_params, 'cost': cost,
+                'generations': options.generations,
+                'n_cores': options.n_cores if mode in ['multiprocessing', 'mpi'] else None,
+                'layout': options.layout,
+                'table_format': options.table_format,
+                'parameter_bundle': options.parameter_bundle}
+
+        if pipeline == 'memory' and mode == 'serial_file':
+            continue
+
+        if mode == 'mpi':
+            if has_mpi is None:
+                has_mpi = mpi_available()
+            if not has_mpi:
+                results.append({'case': case, 'skipped': 'mpirun or mpi4py not available'})
+                continue
+
+        print "[benchmark] Running %s" % json.dumps(case, sort_keys=True)
+
+        result = spawn_case(case, keep=options.keep)
+        result['case'] = case
+        results.append(result)
+
+    f = open(options.output, 'wb')
+    json.dump({'metadata': metadata(), 'results': results}, f, indent=1, sort_keys=True)
+    f.close()
+
+    print
+    summarize(results)
+    print
+    print "Results written to %s" % options.output
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,6 @@
 from genetic import Genetic
+from cache import EvaluationCache
+from layout import list_models, HashedLayout
+from instrument import JSONLinesSink
 
 __version__ = '0.1.2'
\ No newline at end of file
@@ -0,0 +1,266 @@
+import os
+import json
+
+import numpy as np
+
+
+def _native(values):
+    # Columns read from FITS files are usually big-endian
+    values = np.asarray(values)
+    return values.astype(values.dtype.newbyteorder('='))
+
+
+class ColumnStore(object):
+    '''
+    An append-only table kept in memory as one growable array per column,
+    and on disk as one raw binary file per column in the directory
+    specified. The files can be memory-mapped since they contain nothing but
+    the column values, and rows are only ever appended to them. The number
+    of valid rows is recorded by the HistoryArchive that owns the store, so
+    that rows written by an interrupted append are ignored.
+    '''
+
+    def __init__(self, directory):
+        self._directory = directory
+        self._names = []
+        self._dtypes = {}
+        self._buffers = {}
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def names(self):
+        return list(self._names)
+
+    def dtype(self, name):
+        return self._dtypes[name]
+
+    def column(self, name):
+        return self._buffers[name][:self._size]
+
+    def truncate(self, size):
+        # The files are truncated the next time rows are appended
+        self._size = size
+
+    def row(self, index):
+        return dict((name, self._buffers[name][index]) for name in self._names)
+
+    def _column_file(self, name):
+        return os.path.join(self._directory, name + '.bin')
+
+    def header(self):
+        return {'size': self._size,
+                'columns': [[name, self._dtypes[name].str] for name in self._names]}
+
+    def load(self, header):
+        '''
+        Read in the columns described by a header returned by header()
+        '''
+        self._names = [str(name) for name, dtype in header['columns']]
+        self._dtypes = dict((str(name), np.dtype(str(dtype))) for name, dtype in header['columns'])
+        self._size = header['size']
+        self._buffers = {}
+        for name in self._names:
+            if self._size > 0:
+                values = np.memmap(self._column_file(name), mode='r',
+                                   dtype=self._dtypes[name], shape=(self._size,))
+                self._buffers[name] = np.array(values)
+            else:
+                self._buffers[name] = np.zeros(0, dtype=self._dtypes[name])
+
+    def _reserve(self, n_rows):
+        capacity = len(self._buffers[self._names[0]])
+        if self._size + n_rows <= capacity:
+            return
+        capacity = max(2 * capacity, self._size + n_rows)
+        for name in self._names:
+            buffer = np.zeros(capacity, dtype=self._dtypes[name])
+            buffer[:self._size] = self._buffers[name][:self._size]
+            self._buffers[name] = buffer
+
+    def _widen(self, name, dtype):
+        # Only string columns can be widened, in which case the column file
+        # has to be re-written with the new item size.
+        self._dtypes[name] = dtype
+        self._buffers[name] = self._buffers[name].astype(dtype)
+        f = open(self._column_file(name), 'wb')
+        f.write(self._buffers[name][:self._size].tostring())
+        f.close()
+
+    def append(self, columns):
+        '''
+        Append rows to the table, given a dictionary of column arrays. The
+        first call defines the columns of the table.
+        '''
+
+        columns = dict((name, _native(values)) for name, values in columns.items())
+
+        if not self._names:
+            if not os.path.exists(self._directory):
+                os.makedirs(self._directory)
+            self._names = sorted(columns.keys())
+            for name in self._names:
+                self._dtypes[name] = columns[name].dtype
+                self._buffers[name] = np.zeros(0, dtype=columns[name].dtype)
+                open(self._column_file(name), 'wb').close()
+        elif set(columns.keys()) != set(self._names):
+            raise Exception("Columns do not match existing columns: %s" % str(self._names))
+
+        n_rows = len(columns[self._names[0]])
+
+        for name in self._names:
+            values = columns[name]
+            if values.dtype.kind == 'S' and values.dtype.itemsize > self._dtypes[name].itemsize:
+                self._widen(name, values.dtype)
+            columns[name] = values.astype(self._dtypes[name])
+
+        self._reserve(n_rows)
+
+        for name in self._names:
+
+            self._buffers[name][self._size:self._size + n_rows] = columns[name]
+
+            # Discard any rows left over from an interrupted append
+            f = open(self._column_file(name), 'r+b')
+            f.seek(self._size * self._dtypes[name].itemsize)
+            f.truncate()
+            f.write(columns[name].tostring())
+            f.close()
+
+        self._size += n_rows
+
+
+class HistoryArchive(object):
+    '''
+    The parameters and fitting results of all the models computed so far,
+    stored as two append-only column stores in the directory specified. An
+    index from model name to row in the parameters store is kept up to date
+    as generations are appended.
+
+    Each generation is appended once, and the header file listing the
+    generations present and the number of rows in each store is only
+    updated once all the columns have been written, so that an archive
+    interrupted during an append is read back in the state it was in before
+    the append.
+    '''
+
+    def __init__(self, directory):
+        self._directory = directory
+        self.parameters = ColumnStore(os.path.join(directory, 'parameters'))
+        self.fitting = ColumnStore(os.path.join(directory, 'fitting'))
+        self.generations = []
+        self._sizes = []
+        self._index = {}
+        self._log_columns = {}
+        if os.path.exists(self._header_file()):
+            header = json.load(open(self._header_file(), 'rb'))
+            self.generations = header['generations']
+            self._sizes = header['sizes']
+            self.parameters.load(header['parameters'])
+            self.fitting.load(header['fitting'])
+            self._update_index(0)
+
+    def _update_index(self, start):
+        names = self.parameters.column('model_name')
+        for row in range(start, len(names)):
+            self._index[names[row].strip()] = row
+
+    def rows(self, model_names):
+        '''
+        Return the rows of the parameters store for the model names
+        specified.
+        '''
+        return np.array([self._index[name.strip()] for name in model_names], dtype=int)
+
+    def log_column(self, name):
+        '''
+        Return the log10 of a column of the parameters store. This is computed
+        once for each row and kept as the archive grows.
+        '''
+        values = self.parameters.column(name)
+        if name not in self._log_columns:
+            self._log_columns[name] = np.log10(values)
+        else:
+            done = len(self._log_columns[name])
+            if done < len(values):
+                self._log_columns[name] = np.concatenate([self._log_columns[name], np.log10(values[done:])])
+        return self._log_columns[name]
+
+    def values(self, rows, names, log):
+        '''
+        Return an array with one column for each of the parameters specified
+        and one row for each of the rows specified, using the log10 of the
+        values of the parameters for which log is True.
+        '''
+        columns = []
+        for name, is_log in zip(names, log):
+            if is_log:
+                columns.append(self.log_column(name)[rows])
+            else:
+                columns.append(self.parameters.column(name)[rows])
+        return np.column_stack(columns)
+
+    def _header_file(self):
+        return os.path.join(self._directory, 'archive.json')
+
+    def append_generation(self, generation, parameters, fitting):
+        '''
+        Append the parameters and fitting results for a generation, given
+        as dictionaries of column arrays.
+        '''
+
+        if generation in self.generations:
+            raise Exception("Generation %i is already in the archive" % generation)
+
+        start = len(self.parameters)
+        self.parameters.append(parameters)
+        self.fitting.append(fitting)
+        self.generations.append(generation)
+        self._update_index(start)
+        self._sizes.append([len(self.parameters), len(self.fitting)])
+
+        self._write_header()
+
+    def discard(self, generation):
+        '''
+        Remove the generation specified and all later generations from the
+        archive, for example if they are being re-computed.
+        '''
+
+        keep = [i for i in range(len(self.generations)) if self.generations[i] < generation]
+
+        if len(keep) == len(self.generations):
+            return
+
+        self.generations = [self.generations[i] for i in keep]
+        self._sizes = [self._sizes[i] for i in keep]
+
+        if self._sizes:
+            self.parameters.truncate(self._sizes[-1][0])
+            self.fitting.truncate(self._sizes[-1][1])
+        else:
+            self.parameters.truncate(0)
+            self.fitting.truncate(0)
+
+        self._index = {}
+        self._update_index(0)
+        self._log_columns = {}
+
+        self._write_header()
+
+    def _write_header(self):
+
+        if not os.path.exists(self._directory):
+            os.makedirs(self._directory)
+
+        header = {'generations': self.generations,
+                  'sizes': self._sizes,
+                  'parameters': self.parameters.header(),
+                  'fitting': self.fitting.header()}
+
+        f = open(self._header_file() + '.tmp', 'wb')
+        json.dump(header, f)
+        f.close()
+        os.rename(self._header_file() + '.tmp', self._header_file())
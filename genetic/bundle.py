@@ -0,0 +1,120 @@
+import os
+import json
+import tempfile
+
+
+class ParameterBundle(object):
+    '''
+    The parameter files of all the models of a generation, packed into a
+    single file, with an index file giving the position of each parameter
+    file in the bundle so that they can be read individually. This avoids
+    creating many small files, which is slow on parallel filesystems.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._index = None
+
+    def _index_file(self):
+        return self.filename + '.index'
+
+    def write(self, contents):
+        '''
+        Write out the bundle given a list of (model_name, contents) tuples.
+        The index is written last, so that an interrupted bundle is never
+        read back.
+        '''
+
+        index = {}
+
+        f = open(self.filename, 'wb')
+        for model_name, text in contents:
+            index[model_name] = (f.tell(), len(text))
+            f.write(text)
+        f.close()
+
+        f = open(self._index_file() + '.tmp', 'wb')
+        json.dump(index, f)
+        f.close()
+        os.rename(self._index_file() + '.tmp', self._index_file())
+
+        self._index = index
+
+    def _load_index(self):
+        if self._index is None:
+            self._index = dict((str(model_name), position) for model_name, position
+                               in json.load(open(self._index_file(), 'rb')).items())
+        return self._index
+
+    def names(self):
+        '''
+        Return the names of the models in the bundle.
+        '''
+        return sorted(self._load_index().keys())
+
+    def read(self, model_name):
+        '''
+        Return the contents of the parameter file for the model specified.
+        '''
+        offset, length = self._load_index()[model_name]
+        f = open(self.filename, 'rb')
+        f.seek(offset)
+        text = f.read(length)
+        f.close()
+        return text
+
+    def materialize(self, model_name, directory=None):
+        '''
+        Write out the parameter file for the model specified to the
+        directory given, or to a temporary file if no directory is given,
+        and return the path to the file.
+        '''
+        if directory is None:
+            handle, path = tempfile.mkstemp(prefix=model_name + '_', suffix='.par')
+            f = os.fdopen(handle, 'wb')
+        else:
+            path = os.path.join(directory, model_name + '.par')
+            f = open(path, 'wb')
+        f.write(self.read(model_name))
+        f.close()
+        return path
+
+
+class BundledRun(object):
+    '''
+    Wrapper around a model, which given the path to a parameter bundle
+    instead of a parameter file, passes the contents of the parameter file
+    directly to model.run_parameters if the model has that method, or
+    otherwise writes out the parameter file to a temporary file for the
+    duration of model.run.
+    '''
+
+    def __init__(self, model):
+        self.model = model
+        self._bundle = None
+
+    def prepare(self, bundle_file):
+        '''
+        Read the index of the bundle given, so that processes forked to run
+        the models do not each need to read it.
+        '''
+        self._open(bundle_file).names()
+
+    def _open(self, bundle_file):
+        # Keep the index of the last bundle used
+        if self._bundle is None or self._bundle.filename != bundle_file:
+            self._bundle = ParameterBundle(bundle_file)
+        return self._bundle
+
+    def run(self, bundle_file, model_dir, model_name):
+
+        self._open(bundle_file)
+
+        if hasattr(self.model, 'run_parameters'):
+            return self.model.run_parameters(self._bundle.read(model_name), model_dir, model_name)
+
+        par_file = self._bundle.materialize(model_name)
+        try:
+            return self.model.run(par_file, model_dir, model_name)
+        finally:
+            os.remove(par_file)
@@ -0,0 +1,110 @@
+import os
+import time
+import sqlite3
+import hashlib
+import cPickle as pickle
+
+
+class EvaluationCache(object):
+    '''
+    A persistent cache of model results, keyed on the parameter values of
+    the models, and stored in an SQLite database in the file specified so
+    that it can be re-used across runs.
+
+    Parameter values are rounded to precision significant digits before
+    being used as a key, so that values that only differ because of
+    rounding errors (e.g. after being written to and read back from a
+    parameter file) are considered identical. The version string is also
+    included in the key, and should be changed whenever the model changes in
+    a way that affects the results.
+
+    If max_size is set, the least recently used entries are removed once the
+    cache holds more than max_size results.
+    '''
+
+    def __init__(self, filename, precision=8, version=None, max_size=None):
+
+        self.filename = filename
+        self.precision = precision
+        self.version = version
+        self.max_size = max_size
+
+        directory = os.path.dirname(os.path.abspath(filename))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self._db = sqlite3.connect(filename)
+        self._db.text_factory = str
+        self._db.execute('CREATE TABLE IF NOT EXISTS results '
+                         '(key TEXT PRIMARY KEY, value BLOB, last_used REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)')
+        self._db.commit()
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    def key(self, parameters, namespace=''):
+        '''
+        Return the key for a dictionary of parameter values. The namespace
+        can be used to separate results that were obtained for the same
+        parameters in different ways (e.g. with different templates).
+        '''
+        items = ['%s=%.*e' % (name, self.precision - 1, parameters[name])
+                 for name in sorted(parameters)]
+        items.append('version=%s' % self.version)
+        items.append('namespace=%s' % namespace)
+        return hashlib.sha1('\n'.join(items)).hexdigest()
+
+    def get_many(self, parameters, namespace=''):
+        '''
+        Look up the results for a list of dictionaries of parameter values.
+        Return a dictionary of the results found, indexed by the position of
+        the parameters in the list.
+        '''
+
+        keys = [self.key(p, namespace=namespace) for p in parameters]
+
+        results = {}
+        found = []
+        for i, key in enumerate(keys):
+            row = self._db.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                results[i] = pickle.loads(str(row[0]))
+                found.append(key)
+
+        if found:
+            now = time.time()
+            self._db.executemany('UPDATE results SET last_used = ? WHERE key = ?',
+                                 [(now, key) for key in found])
+            self._db.commit()
+
+        return results
+
+    def put_many(self, parameters, results, namespace=''):
+        '''
+        Store the results for a list of dictionaries of parameter values, then
+        remove the least recently used entries if the cache is too large.
+        '''
+
+        now = time.time()
+        self._db.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+                             [(self.key(p, namespace=namespace),
+                               sqlite3.Binary(pickle.dumps(r, pickle.HIGHEST_PROTOCOL)), now)
+                              for p, r in zip(parameters, results)])
+
+        if self.max_size is not None:
+            excess = len(self) - self.max_size
+            if excess > 0:
+                self._db.execute('DELETE FROM results WHERE key IN '
+                                 '(SELECT key FROM results ORDER BY last_used LIMIT ?)', (excess,))
+
+        self._db.commit()
+
+    def get(self, parameters, default=None, namespace=''):
+        return self.get_many([parameters], namespace=namespace).get(0, default)
+
+    def put(self, parameters, result, namespace=''):
+        self.put_many([parameters], [result], namespace=namespace)
+
+    def close(self):
+        self._db.close()
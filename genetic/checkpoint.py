@@ -0,0 +1,130 @@
+import os
+import json
+import threading
+import cPickle as pickle
+
+
+def _write_durably(filename, contents):
+    # Write to a temporary file and rename it, so that the file always
+    # contains either the old or the new contents
+    f = open(filename + '.tmp', 'wb')
+    f.write(contents)
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    os.rename(filename + '.tmp', filename)
+
+
+class RunManifest(object):
+    '''
+    A record of the progress of a run, kept in a JSON file that is
+    re-written atomically whenever a step of a generation is completed.
+    For each generation started, the manifest records which steps are done
+    and the state of the random number generator after the parameter table
+    was made, so that a run can be resumed where it stopped.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        if os.path.exists(filename):
+            self._generations = dict((int(g), steps) for g, steps
+                                     in json.load(open(filename, 'rb'))['generations'].items())
+        else:
+            self._generations = {}
+
+    def _write(self):
+        generations = dict((str(g), steps) for g, steps in self._generations.items())
+        _write_durably(self.filename, json.dumps({'generations': generations}))
+
+    def get(self, generation, step):
+        return self._generations.get(generation, {}).get(step)
+
+    def latest(self, generation, step):
+        '''
+        Return the value recorded for the step specified by the latest
+        generation before the one specified that recorded it, or None.
+        '''
+        for g in sorted(self._generations, reverse=True):
+            if g < generation and self.get(g, step) is not None:
+                return self.get(g, step)
+        return None
+
+    def started(self, generation):
+        return generation in self._generations
+
+    def mark(self, generation, step, value=True):
+        self._generations.setdefault(generation, {})[step] = value
+        self._write()
+
+    def discard(self, generation):
+        '''
+        Forget the generation specified and all later generations.
+        '''
+        later = [g for g in self._generations if g >= generation]
+        if later:
+            for g in later:
+                del self._generations[g]
+            self._write()
+
+    def last_completed(self):
+        '''
+        Return the last generation for which all the steps are done, such
+        that all the previous generations are also done, or 0 if there is
+        none.
+        '''
+        generation = 0
+        while self.get(generation + 1, 'complete'):
+            generation += 1
+        return generation
+
+
+class CompletionLog(object):
+    '''
+    An append-only log of the models of a generation that are done. Each
+    record is written out as soon as the model is done, and contains the
+    model name, its status ('ok' or the reason it failed), and optionally
+    its output. A record only partially written when the run was
+    interrupted is ignored, and overwritten by the next record. Records
+    can be added from several threads.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+
+    def read(self):
+        '''
+        Return a dictionary giving the status and output of each model in
+        the log.
+        '''
+
+        records = {}
+
+        if not os.path.exists(self.filename):
+            return records
+
+        f = open(self.filename, 'rb')
+        end = 0
+        while True:
+            try:
+                model_name, status, output = pickle.load(f)
+            except Exception:
+                break
+            records[model_name] = (status, output)
+            end = f.tell()
+        f.close()
+
+        # Remove any partial record at the end of the file
+        if end < os.path.getsize(self.filename):
+            f = open(self.filename, 'r+b')
+            f.truncate(end)
+            f.close()
+
+        return records
+
+    def record(self, model_name, status, output=None):
+        record = pickle.dumps((model_name, status, output), pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            f = open(self.filename, 'ab')
+            f.write(record)
+            f.close()
@@ -0,0 +1,135 @@
+# Initial designs for the first generation. Each design is a function that
+# given a number of points n, a number of dimensions d, and a random state,
+# returns an (n, d) array of points in the unit hypercube. The points are then
+# scaled to the parameter ranges in the space in which each parameter is
+# sampled (linear or log).
+
+import numpy as np
+
+
+def uniform(n, d, random_state):
+    '''
+    Independent uniform random points.
+    '''
+    return random_state.random_sample((n, d))
+
+
+def latin_hypercube(n, d, random_state):
+    '''
+    Latin hypercube sample: along each dimension, exactly one point falls in
+    each of n equal intervals.
+    '''
+    points = np.zeros((n, d))
+    for j in range(d):
+        points[:, j] = (random_state.permutation(n) + random_state.random_sample(n)) / float(n)
+    return points
+
+
+# Primitive polynomials (degree and interior coefficients) and initial
+# direction numbers for dimensions 2 and above, from Joe & Kuo (2008)
+
+_sobol_table = [(1, 0, [1]),
+                (2, 1, [1, 3]),
+                (3, 1, [1, 3, 1]),
+                (3, 2, [1, 1, 1]),
+                (4, 1, [1, 1, 3, 3]),
+                (4, 4, [1, 3, 5, 13]),
+                (5, 2, [1, 1, 5, 5, 17]),
+                (5, 4, [1, 1, 5, 5, 5]),
+                (5, 7, [1, 1, 7, 11, 19]),
+                (5, 11, [1, 1, 5, 1, 1]),
+                (5, 13, [1, 1, 1, 3, 11]),
+                (5, 14, [1, 3, 5, 5, 31]),
+                (6, 1, [1, 3, 3, 9, 7, 49]),
+                (6, 13, [1, 1, 1, 15, 21, 21]),
+                (6, 16, [1, 3, 1, 13, 27, 49]),
+                (6, 19, [1, 1, 1, 15, 7, 5]),
+                (6, 22, [1, 3, 1, 15, 13, 25]),
+                (6, 25, [1, 1, 5, 5, 19, 61])]
+
+_sobol_bits = 30
+
+
+def _sobol_directions(d):
+
+    directions = np.zeros((d, _sobol_bits), dtype=np.int64)
+
+    for k in range(_sobol_bits):
+        directions[0, k] = 1 << (_sobol_bits - 1 - k)
+
+    for j in range(1, d):
+        s, a, m = _sobol_table[j - 1]
+        v = []
+        for k in range(_sobol_bits):
+            if k < s:
+                x = m[k] << (_sobol_bits - 1 - k)
+            else:
+                x = v[k - s] ^ (v[k - s] >> s)
+                for i in range(1, s):
+                    if (a >> (s - 1 - i)) & 1:
+                        x ^= v[k - i]
+            v.append(x)
+        directions[j] = v
+
+    return directions
+
+
+def sobol(n, d, random_state):
+    '''
+    Sobol sequence, randomized with a digital shift.
+    '''
+
+    if d > len(_sobol_table) + 1:
+        raise Exception("Sobol sequences are only available for up to %i parameters" % (len(_sobol_table) + 1))
+
+    if n > 2 ** _sobol_bits:
+        raise Exception("Sobol sequences are only available for up to 2^%i points" % _sobol_bits)
+
+    directions = _sobol_directions(d)
+
+    # The i-th point is the XOR of the direction numbers for the bits set in
+    # the Gray code of i
+    gray = np.arange(n, dtype=np.int64)
+    gray ^= gray >> 1
+
+    points = np.zeros((n, d), dtype=np.int64)
+    for k in range(_sobol_bits):
+        points ^= ((gray >> k) & 1)[:, np.newaxis] * directions[:, k][np.newaxis, :]
+
+    points ^= random_state.randint(0, 2 ** _sobol_bits, d).astype(np.int64)
+
+    return points / float(2 ** _sobol_bits)
+
+
+def _primes(n):
+    primes = []
+    candidate = 2
+    while len(primes) < n:
+        if all(candidate % p != 0 for p in primes):
+            primes.append(candidate)
+        candidate += 1
+    return primes
+
+
+def halton(n, d, random_state):
+    '''
+    Halton sequence, randomized with a random shift modulo 1.
+    '''
+
+    points = np.zeros((n, d))
+
+    for j, base in enumerate(_primes(d)):
+        index = np.arange(n)
+        scale = 1.
+        while np.any(index > 0):
+            scale /= base
+            points[:, j] += scale * (index % base)
+            index //= base
+
+    return (points + random_state.random_sample(d)) % 1.
+
+
+designs = {'uniform': uniform,
+           'latin_hypercube': latin_hypercube,
+           'sobol': sobol,
+           'halton': halton}
@@ -0,0 +1,79 @@
+# Diagnostic plots and lineage of the models, written out in the background
+# by DiagnosticsWriter. matplotlib is only imported when a plot is made, and
+# is not needed at all if the diagnostic plots are turned off. The plots are
+# drawn on their own figure and canvas rather than with pyplot, whose global
+# state is not safe to use from a background thread while fitters use it in
+# the main thread.
+
+import threading
+import traceback
+import Queue
+
+
+def _figure():
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def plot_sampling(parents, filename):
+    '''
+    Plot the histogram of the positions of the selected parents in the list
+    of models sorted by chi^2.
+    '''
+    fig = _figure()
+    ax = fig.add_subplot(111)
+    ax.hist(parents, 50)
+    fig.savefig(filename)
+
+
+def lineage_table(model_names, operations, parents1, parents2):
+    '''
+    Return the lineage of the models given as a structured array, with the
+    operation ('crossover' or 'mutation') that produced each model and the
+    names of its parents. The second parent is empty for mutations.
+    '''
+    from tables import make_table
+    return make_table([('model_name', model_names, '|S30'),
+                       ('operation', operations, '|S9'),
+                       ('parent1', parents1, '|S30'),
+                       ('parent2', parents2, '|S30')])
+
+
+class DiagnosticsWriter(object):
+    '''
+    Write out diagnostics in a background thread, so that the run never
+    waits for them. Each task is a function that is called with the
+    arguments given, in the order in which the tasks were submitted. A task
+    that fails is reported but does not stop the run.
+    '''
+
+    def __init__(self):
+        self._queue = Queue.Queue()
+        self._thread = None
+
+    def submit(self, function, *args):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._work)
+            self._thread.daemon = True
+            self._thread.start()
+        self._queue.put((function, args))
+
+    def _work(self):
+        while True:
+            function, args = self._queue.get()
+            try:
+                function(*args)
+            except Exception:
+                print "[genetic] Writing diagnostics failed:"
+                traceback.print_exc()
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        '''
+        Wait for all the tasks submitted so far to be done.
+        '''
+        self._queue.join()
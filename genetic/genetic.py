@@ -1,216 +1,502 @@
-import sys
+import re
 import string
-import glob
+import functools
+from collections import deque
 import os
+import shutil
 import time
-import random as r
 import signal
+import tempfile
+import traceback
+import threading
+import Queue
+import hashlib
 
-import atpy
 import numpy as np
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as mpl
-import multiprocessing as mp
-import subprocess
-
-try:
-    from mpi4py import MPI
-    mpi_enabled = True
-    comm = MPI.COMM_WORLD
-    rank = comm.Get_rank()
-    nproc = comm.Get_size()
-    status = MPI.Status()
-except:
-    mpi_enabled = False
-    rank = 0
-    nproc = 1
-
-wait_time = 1.
-delta = 0.1
+
+import mpi
+from archive import HistoryArchive
+from cache import EvaluationCache
+from checkpoint import RunManifest, CompletionLog
+from template import CompiledTemplate
+from bundle import ParameterBundle, BundledRun
+from layout import layouts, write_index
+from design import designs
+from scheduler import Job, ProcessScheduler, clock
+from tables import table_formats, make_table
+from diagnostics import DiagnosticsWriter, lineage_table, plot_sampling
+from instrument import Instrumentation, Profiled, output_size, run_profiled_child, merge_profiles
+
 n_max_sample = 10000
+max_oversample = 100
+
+# Model names, as found at the start of the files written by the models
+_model_name = re.compile(r'g\d+_\d+')
+
+# Objects used by the workers of the multiprocessing pool, indexed by the name
+# of the method called on them. These are passed to the pool initializer, so
+# that they are sent to each worker once when the pool is created rather than
+# with every task.
+
+_worker_objects = {}
+
+
+def _init_worker(objects):
+    _worker_objects.update(objects)
+
 
-# The following is Steven Bethard's functions to pickle methods - required to
-# use multiprocessing.Pool with model.run
-
-def _pickle_method(method):
-    func_name = method.im_func.__name__
-    obj = method.im_self
-    cls = method.im_class
-    return _unpickle_method, (func_name, obj, cls)
-
-def _unpickle_method(func_name, obj, cls):
-    for cls in cls.mro():
-        try:
-            func = cls.__dict__[func_name]
-        except KeyError:
-            pass
+def _call_worker(task):
+    index, method, args, max_time = task
+    result, timing = call_timed(getattr(_worker_objects[method], method), args, max_time)
+    return index, result, timing
+
+
+def _call_worker_safe(task):
+    # Used with apply_async, for which exceptions would prevent the callback
+    # from being called, so they are returned instead
+    try:
+        return _call_worker(task)
+    except Exception, e:
+        traceback.print_exc()
+        return task[0], e, None
+
+
+class ModelTimeout(Exception):
+    pass
+
+
+def _raise_timeout(signum, frame):
+    raise ModelTimeout()
+
+
+def call_with_timeout(function, args, max_time):
+    '''
+    Call function(*args) and return the result, or a ModelTimeout instance
+    if the call took longer than max_time seconds. This uses SIGALRM, so it
+    can only be used in the main thread, and only interrupts Python code
+    (including waiting for a subprocess), not long calls to compiled code,
+    and processes started by the function are not stopped. It is only used
+    as a fallback for model.evaluate in the memory pipeline: models run from
+    parameter files are computed with SupervisedRun, which can always stop
+    them.
+    '''
+    if max_time is None:
+        return function(*args)
+    previous = signal.signal(signal.SIGALRM, _raise_timeout)
+    signal.setitimer(signal.ITIMER_REAL, max_time)
+    try:
+        return function(*args)
+    except ModelTimeout, e:
+        return e
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def call_timed(function, args, max_time):
+    '''
+    Call call_with_timeout, and return the result along with a (start, end,
+    worker, rank) tuple giving the start and end time of the call, the
+    process ID, and the MPI rank.
+    '''
+    start = time.time()
+    result = call_with_timeout(function, args, max_time)
+    return result, (start, time.time(), os.getpid(), mpi.rank)
+
+
+class SupervisedRun(object):
+    '''
+    Wrapper around a model that computes each model in a separate process,
+    which is killed along with any processes it started if it runs for
+    longer than max_time. Returns the exit code of the process, or a
+    ModelTimeout instance if the process was killed. If profile_dir is set,
+    the profiles of the process are merged into those of this process.
+    '''
+
+    def __init__(self, model, max_time, start_dir, fitter=None, profile_dir=None):
+        self.model = model
+        self.max_time = max_time
+        self.start_dir = start_dir
+        self.fitter = fitter
+        self.profile_dir = profile_dir
+
+    def run(self, par_file, model_dir, model_name):
+        os.chdir(self.start_dir)
+        if isinstance(self.model, BundledRun):
+            # Read the index of the bundle once, before forking
+            self.model.prepare(par_file)
+        if self.profile_dir is None:
+            job = Job(model_name, (par_file, model_dir, model_name), function=self.model.run)
+            ProcessScheduler(max_time=self.max_time, verbose=False).run([job])
         else:
-            break
-    return func.__get__(obj, cls)
+            child_dir = tempfile.mkdtemp(prefix='genetic_profile_')
+            job = Job(model_name, (child_dir, self.model.run, par_file, model_dir, model_name),
+                      function=run_profiled_child)
+            try:
+                ProcessScheduler(max_time=self.max_time, verbose=False).run([job])
+            finally:
+                merge_profiles(child_dir, self.profile_dir)
+        if job.timed_out:
+            return ModelTimeout()
+        else:
+            return job.returncode
+
+    def run_and_fit(self, par_file, model_dir, model_name):
+        # Also fit the model with fitter.fit_one if it succeeded, and return
+        # the fitting results along with the exit code
+        result = self.run(par_file, model_dir, model_name)
+        if isinstance(result, ModelTimeout) or result != 0:
+            return result, None
+        else:
+            return result, self.fitter.fit_one(model_dir, model_name)
+
+
+def create_dir(dir_name, overwrite=False):
+    delete_dir(dir_name, overwrite=overwrite)
+    os.mkdir(dir_name)
 
-def sleep(seconds):
-    time1 = time.time()
-    while time.time() < time1 + seconds:
-        pass
 
-import copy_reg
-import types
+def delete_dir(dir_name, overwrite=False):
+    if os.path.exists(dir_name):
+        if overwrite:
+            shutil.rmtree(dir_name)
+        else:
+            raise Exception("Directory %s already exists (use overwrite=True to replace it)" % dir_name)
 
-copy_reg.pickle(types.MethodType, _pickle_method, _unpickle_method)
 
-# Define a class to allow multiple arguments to be passed to model.run
+# Tournament selection routine
+# Good parameters for getting ~10% are k_frac=0.2 and p=0.9
 
-class RunWrapper(object):
+def select(chi2, n, k_frac, p):
+    return select_batch(chi2, n, k_frac, p).tolist()
 
-    def __init__(self, function):
-        self.function = function
 
-    def __call__(self, args):
-        return self.function(*args)
+def _log_factorials(n):
+    # log(x!) for x = 0 to n, used to evaluate binomial coefficient ratios
+    return np.concatenate([[0.], np.cumsum(np.log(np.arange(1., n + 1.)))])
 
 
-def low_cpu_barrier():
+def _subset_minimum(size, k, log_fact, random_state):
+    '''
+    For each element of the arrays size and k, return the smallest value of a
+    random k-element subset of range(size), without drawing the subset. The
+    probability that the minimum is at least m is C(size - m, k) / C(size, k),
+    which is inverted by bisection.
+    '''
 
-    if rank == 0:
+    log_u = np.log(random_state.random_sample(len(size)))
 
-        for dest in range(1, nproc):
-            print "[mpi] rank 0 sending exit to rank %i" % dest
-            comm.send({'model': 'exit'}, dest=dest, tag=3)
+    lower = np.zeros(len(size), dtype=int)
+    upper = size - k + 1
 
-    else:
+    while np.any(upper - lower > 1):
+        middle = (lower + upper) // 2
+        log_prob = log_fact[size - middle] - log_fact[size - middle - k] \
+                   - log_fact[size] + log_fact[size - k]
+        above = log_prob > log_u
+        lower = np.where(above, middle, lower)
+        upper = np.where(above, upper, middle)
 
-        while True:
-            status = MPI.Status()
-            comm.Iprobe(source=0, tag=3, status=status)
-            if status.source == 0:
-                break
-            time.sleep(delta)
+    return lower
 
-        data = comm.recv(source=0, tag=3)
 
-    comm.barrier()
+def select_batch(chi2, n, k_frac, p, random_state=None):
+    '''
+    Run n independent tournaments and return the indices of the winners.
 
+    Each tournament is equivalent to the one in the original select: k models
+    are drawn without replacement, sorted by chi^2, and the j-th best is
+    chosen with probability proportional to p * (1 - p) ** j. Rather than
+    drawing every pool, the rank of the winner within its pool is drawn from
+    the cumulative probabilities, and the rank of that model among all
+    models is then drawn from the order statistics of a random k-subset, so
+    the cost does not depend on the size of the pool.
+    '''
 
-def kill_all(ppid):
+    if random_state is None:
+        random_state = np.random
 
-    pids = os.popen("ps -x -e -o pid,ppid | awk '{if($2 == " + str(ppid) + ") print $1}'").read().split()
+    chi2 = np.asarray(chi2)
 
-    if type(pids) != list:
-        pids = (pids, )
+    k = int(len(chi2) * k_frac)
 
-    for pid in pids:
-        pid = pid.strip()
-        if pid:
-            pid = int(pid)
-            kill_all(pid)
+    assert k > 0, "k_frac is too small"
 
-    try:
-        os.kill(ppid, signal.SIGKILL)
-        print "PID: ", ppid, " killed"
-    except:
-        print "PID: ", ppid, " does not exist"
-
-    return
-
-
-def etime(pid):
-    cols = os.popen('ps -xe -o pid,etime | grep ' + str(pid)).read().strip().split()
-    if len(cols) == 0:
-        return 0
-    else:
-        cols = cols[1].split(':')
-        if len(cols) == 2:
-            d = 0
-            h = 0
-            m, s = cols
-        elif len(cols) == 3:
-            h, m, s = cols
-            if '-' in h:
-                d, h = h.split('-')
+    prob = p * (1. - p) ** np.arange(k)
+    cumulative = np.cumsum(prob / np.sum(prob))
+
+    # Rank of the winner within each tournament
+    xi = random_state.random_sample(n)
+    j = np.minimum(np.searchsorted(cumulative, xi), k - 1)
+
+    # Rank of the winner among all the models. The j-th smallest element of
+    # a random k-subset is found by repeatedly drawing the minimum of the
+    # remaining elements above the previous one.
+    log_fact = _log_factorials(len(chi2))
+    offset = np.zeros(n, dtype=int)
+    size = np.repeat(len(chi2), n)
+    remaining = np.repeat(k, n)
+    rank = np.zeros(n, dtype=int)
+    for step in range(j.max() + 1 if n > 0 else 0):
+        active = j >= step
+        m = _subset_minimum(size[active], remaining[active], log_fact,
+                            random_state)
+        rank[active] = offset[active] + m
+        offset[active] += m + 1
+        size[active] -= m + 1
+        remaining[active] -= 1
+
+    # Ties in chi^2 are broken by index, as when sorting (chi2, id) pairs
+    order = np.argsort(chi2, kind='mergesort')
+
+    return order[rank]
+
+
+# Crossover and mutation operators. These work on arrays of parameters with
+# one row per child, in the space in which the parameters are sampled (i.e.
+# log10 of the values for parameters sampled logarithmically).
+
+def crossover(parents1, parents2, random_state=None):
+    '''
+    Return children that are random weighted averages of two parents, with
+    an independent weight for each parameter.
+    '''
+    if random_state is None:
+        random_state = np.random
+    xi = random_state.random_sample(parents1.shape)
+    return parents1 * xi + parents2 * (1. - xi)
+
+
+def mutate(parents, mutated, lower, upper, random_state=None):
+    '''
+    Return children that are copies of the parents in which the parameter
+    with index mutated is replaced by a random value between lower and
+    upper. Values of mutated outside the range of parameter indices leave
+    the child unchanged.
+    '''
+    if random_state is None:
+        random_state = np.random
+    children = parents.copy()
+    n_par = parents.shape[1]
+    for j in range(n_par):
+        change = mutated == j
+        children[change, j] = random_state.uniform(lower[j], upper[j], np.sum(change))
+    return children
+
+
+class _SteadyState(object):
+    '''
+    Book-keeping for Genetic.run_steady_state: hands out the models of the
+    first generation and then new children bred from the best models so
+    far, and collects the results as they arrive.
+
+    Children are grouped into generations of n_output models, which are
+    written out like normal generations once all their results are in.
+    '''
+
+    def __init__(self, genetic, n_evaluations, fitter, validate, batch_validate):
+
+        self.genetic = genetic
+        self.n_evaluations = n_evaluations
+        self.fitter = fitter
+        self.validate = validate
+        self.batch_validate = batch_validate
+
+        self.n_output = int(genetic.n_models * genetic._fraction_output)
+        self.dtype = [('model_name', '|S30')] + [(name, float) for name in genetic._par_names]
+
+        # The n_models best models so far, sorted by chi^2
+        self.best_chi2 = np.zeros(0)
+        self.best_names = np.zeros(0, dtype='|S30')
+        self.best_values = np.zeros((0, len(genetic._par_names)))
+
+        # Generation and values (in sampling space) of the models running,
+        # and the time at which they were handed out
+        self.running = {}
+        self.queued = {}
+        self.generations = {}
+
+        rows = genetic._parameter_rows(1)
+        self.initial = deque()
+        block = self._new_generation(1)
+        for row in rows:
+            model_name = row['model_name'].strip()
+            parameters = dict((name, float(row[name])) for name in genetic._par_names)
+            self._add(block, model_name, parameters, None)
+        block['closed'] = True
+        self.initial.extend(block['names'])
+
+        self.n_born = len(rows)
+        self.generation = 1
+
+    def _new_generation(self, generation):
+        block = {'generation': generation, 'names': [], 'parameters': {},
+                 'results': {}, 'failures': {}, 'lineage': [], 'closed': False}
+        self.generations[generation] = block
+        return block
+
+    def _add(self, block, model_name, parameters, lineage):
+        values = np.array([parameters[name] for name in self.genetic._par_names])
+        values[self.genetic._par_log] = np.log10(values[self.genetic._par_log])
+        block['names'].append(model_name)
+        block['parameters'][model_name] = parameters
+        if lineage is not None:
+            block['lineage'].append(lineage)
+        self.running[model_name] = (block['generation'], values)
+
+    def _breed(self):
+
+        g = self.genetic
+
+        if self.generation == 1 or len(self.generations[self.generation]['names']) == self.n_output:
+            if self.generation in self.generations:
+                self.generations[self.generation]['closed'] = True
+                self._check_complete(self.generation)
+            self.generation += 1
+            g.initialize(self.generation)
+            self._new_generation(self.generation)
+
+        block = self.generations[self.generation]
+        model_name = "g%i_%i" % (self.generation, len(block['names']))
+
+        is_crossover = g._random.random_sample() > g._fraction_mutation
+        parents = select_batch(self.best_chi2, n=1 + int(is_crossover),
+                               k_frac=0.1, p=0.9, random_state=g._random)
+        parents1 = self.best_values[parents[:1]]
+        parents2 = self.best_values[parents[-1:]]
+        mutated = g._random.randint(0, len(g._par_names) + 1, 1)
+
+        def propose(index):
+            if is_crossover:
+                return crossover(parents1.repeat(len(index), axis=0),
+                                 parents2.repeat(len(index), axis=0),
+                                 random_state=g._random)
             else:
-                d = 0
-        elif len(cols) == 4:
-            d, h, m, s = cols
-        else:
-            raise Exception("Can't understand " + str(cols))
+                return mutate(parents1.repeat(len(index), axis=0),
+                              mutated.repeat(len(index)),
+                              g._par_lower, g._par_upper,
+                              random_state=g._random)
+
+        data = np.zeros(1, dtype=self.dtype)
+        data['model_name'] = model_name
+        g._sample_valid(data, propose, self.validate, self.batch_validate)
 
-        d = float(d)
-        h = float(h)
-        m = float(m)
-        s = float(s)
+        if is_crossover:
+            lineage = (model_name, 'crossover', self.best_names[parents[0]], self.best_names[parents[1]])
+        else:
+            lineage = (model_name, 'mutation', self.best_names[parents[0]], '')
 
-        return ((d * 24 + h) * 60 + m) * 60 + s
+        parameters = dict((name, float(data[name][0])) for name in g._par_names)
+        self._add(block, model_name, parameters, lineage)
+        self.n_born += 1
 
+        if self.n_born == self.n_evaluations:
+            block['closed'] = True
 
-def kill_inactive(seconds):
-    for p in mp.active_children():
-        if etime(p.pid) > seconds:
-            print "Process %i has exceeded %i seconds, terminating" % (p.pid, seconds)
-            kill_all(p.pid)
+        return model_name, parameters
 
+    def next_task(self):
+        '''
+        Return the name and parameters of the next model to compute, or None
+        if all the models have been handed out, or if too few models have
+        been computed so far to select parents (in which case more results
+        are needed before a child can be bred).
+        '''
+        if len(self.initial) > 0:
+            model_name = self.initial.popleft()
+            task = model_name, self.generations[1]['parameters'][model_name]
+        elif self.n_born < self.n_evaluations and int(len(self.best_chi2) * 0.1) >= 1:
+            task = self._breed()
+        else:
+            return None
+        self.queued[task[0]] = time.time()
+        return task
 
-def wait_with_timeout(p, seconds):
-    while True:
-        if not p in mp.active_children():
-            break
-        if etime(p.pid) > seconds:
-            print "Process %i has exceeded %i seconds, terminating" % (p.pid, seconds)
-            kill_all(p.pid)
-        time.sleep(wait_time)
+    def check_stalled(self):
+        '''
+        Raise an exception if no model is running but models are left to
+        compute, which happens when too few models succeeded to select
+        parents from.
+        '''
+        if len(self.running) == 0 and self.n_born < self.n_evaluations:
+            raise Exception("Only %i models succeeded, which is not enough to select parents "
+                            "(at least 10 are needed)" % len(self.best_chi2))
 
+    def add_result(self, model_name, output, timing=None):
+        '''
+        Record the output of model.evaluate for the model specified, and
+        the (start, end, worker, rank) tuple returned by call_timed if any.
+        '''
 
-def create_dir(dir_name):
-    delete_dir(dir_name)
-    os.system("mkdir " + dir_name)
+        generation, values = self.running.pop(model_name)
+        queued = self.queued.pop(model_name)
+        block = self.generations[generation]
 
+        if timing is not None:
+            status = 'timeout' if isinstance(output, ModelTimeout) else 'ok'
+            self.genetic._record_model(generation, model_name, status, (queued,) + timing,
+                                       None if status == 'timeout' else output)
 
-def delete_dir(dir_name):
-    if os.path.exists(dir_name):
-        reply = raw_input("Delete directory " + dir_name + "? [y/[n]] ")
-        if reply == 'y':
-            os.system('rm -r ' + dir_name)
+        if isinstance(output, ModelTimeout):
+            block['failures'][model_name] = 'timeout'
         else:
-            print "Aborting..."
-            sys.exit()
-
+            row = self.genetic._fit_output(self.fitter, model_name, output)
+            block['results'][model_name] = row
+            position = np.searchsorted(self.best_chi2, row['chi2'], side='right')
+            if position < self.genetic.n_models:
+                self.best_chi2 = np.insert(self.best_chi2, position, row['chi2'])[:self.genetic.n_models]
+                self.best_names = np.insert(self.best_names, position, model_name)[:self.genetic.n_models]
+                self.best_values = np.insert(self.best_values, position, values, axis=0)[:self.genetic.n_models]
 
-# Tournament selection routine
-# Good parameters for getting ~10% are k_frac=0.2 and p=0.9
+        self._check_complete(generation)
 
-def select(chi2, n, k_frac, p):
+    def _check_complete(self, generation):
 
-    k = int(len(chi2) * k_frac)
+        block = self.generations[generation]
 
-    assert k > 0, "k_frac is too small"
+        if not block['closed'] or len(block['results']) + len(block['failures']) < len(block['names']):
+            return
 
-    model_id = [i for i in range(len(chi2))]
+        g = self.genetic
 
-    prob = [p * (1 - p) ** j for j in range(k)]
-    norm = sum(prob)
-    for i in range(len(prob)):
-        prob[i] = prob[i] / norm
+        print "[genetic] Generation %i: complete, best fit so far: %s %g" % (generation, self.best_names[0], self.best_chi2[0])
 
-    choices = []
+        if generation > 1:
 
-    for t in range(n):
+            columns = [('model_name', block['names'], '|S30')]
+            for name in g._par_names:
+                columns.append((name, [block['parameters'][model_name][name] for model_name in block['names']]))
+            g._tables.write(g._parameter_table(generation), make_table(columns))
 
-        pool_id = r.sample(model_id, k)
+            g._write_lineage(generation, lineage_table(*zip(*block['lineage'])))
 
-        pool_chi = chi2[pool_id]
+        model_names = [model_name for model_name in block['names'] if model_name in block['results']]
+        g._write_fitting_results(generation, model_names, [block['results'][model_name] for model_name in model_names])
+        g._record_failures(generation, block['failures'])
+        g._models_done(generation)
+        g._write_timings(generation)
 
-        aux_list = zip(pool_chi, pool_id)
-        aux_list.sort()
-        pool_chi, pool_id = map(list, zip(*aux_list))
+        del self.generations[generation]
 
-        xi = r.random()
-        for j in range(k):
-            if(xi <= sum(prob[0: j + 1])):  # is  + 1 because prob[0: 0] is empty
-                choice = pool_id[j]
-                choices.append(choice)
-                break
 
-    return(choices)
+def _stage(name, last=False):
+    '''
+    Decorator for the methods of Genetic that run a stage of a generation,
+    which records the time taken by the stage. After the last stage, the
+    timings of the generation are written out.
+    '''
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, generation, *args, **kwargs):
+            if self._instrumentation is None:
+                return method(self, generation, *args, **kwargs)
+            with self._instrumentation.stage(generation, name):
+                result = method(self, generation, *args, **kwargs)
+            if last:
+                self._write_timings(generation)
+            return result
+        return wrapper
+    return decorator
 
 
 class Genetic(object):
@@ -218,7 +504,11 @@ class Genetic(object):
     def __init__(self, n_models, output_dir, template, configuration,
                  existing=False, fraction_output=0.1, fraction_mutation=0.5,
                  mode='serial', n_cores=None, max_time=600, submit_delay=0.,
-                 submit_limit=np.inf):
+                 submit_limit=np.inf, seed=None, initial_design='uniform',
+                 pipeline='files', chunk_size=None, cache=None, resume=False,
+                 parameter_bundle=False, layout='flat', overwrite=False,
+                 table_format='fits', diagnostics=True, instrument=False,
+                 sinks=None, profile=False):
         '''
         The Genetic class is used to control the SED fitter genetic algorithm
 
@@ -265,7 +555,16 @@ class Genetic(object):
            and the number of cores is set by mpirun/mpiexec.
 
         max_time: float, optional
-           Maximum number of seconds a model can run for
+           Maximum number of seconds a model can run for. Models that take
+           longer are stopped and recorded as failed in failures.txt in the
+           generation directory, along with models that exit with a non-zero
+           code or raise an exception. Failed models are never selected as
+           parents. With the files pipeline, each model is computed in a
+           child process, which is killed along with any processes it
+           started if it runs for too long. With the memory pipeline,
+           model.evaluate is instead interrupted with SIGALRM, which stops
+           Python code but not long calls to compiled code or processes
+           started by the model.
 
         submit_delay: float
             How long to wait between each job submission when using
@@ -274,6 +573,119 @@ class Genetic(object):
         submit_limit: float
             The maximum number of jobs that can be submitted when using
             mode='serial_file'.
+
+        seed: int, optional
+            Seed for the random number generator used to select parents, so
+            that the selection can be reproduced.
+
+        initial_design: str or function, optional
+            How to sample the parameters of the first generation. Can be one
+            of 'uniform' (independent random values), 'latin_hypercube',
+            'sobol' or 'halton', or a function that given a number of models
+            n, a number of parameters d, and a numpy RandomState, returns an
+            (n, d) array of values between 0 and 1. Models rejected by the
+            validation function are re-sampled uniformly.
+
+        pipeline: str, optional
+            How parameters and results are passed to and from the models. In
+            the 'files' pipeline, a parameter file is written for each model
+            by make_par_indiv, models are computed with model.run, and fitted
+            with fitter.run. In the 'memory' pipeline, the parameters of each
+            model are passed directly as a dictionary to model.evaluate, and
+            the results are kept in memory until compute_fits writes out the
+            fitting results. This cannot be used with mode='serial_file'.
+
+        chunk_size: int, optional
+            Number of models sent at a time to each process when using
+            mode='multiprocessing' or mode='mpi'. By default, the models are
+            split into about four chunks per process.
+
+        cache: str or EvaluationCache, optional
+            Cache of model results, so that models with the same parameters
+            as a model computed before, in this run or a previous one, are
+            not computed again. This can be the name of the file in which to
+            keep the cache, or an EvaluationCache instance to set the
+            precision, model version, and maximum size of the cache. With the
+            memory pipeline, the outputs of model.evaluate are cached. With
+            the files pipeline, the fitting results of each model are cached,
+            so the fitter should not change between runs sharing a cache.
+            Results are only re-used with the same template and pipeline.
+
+        resume: bool, optional
+            Whether to resume a run that was interrupted. The progress of
+            each run is recorded in run.json in the output directory, and
+            next_generation gives the generation from which to continue.
+            Generations that were started are picked up where they stopped:
+            the parameter table is not made again, and only the models that
+            are not recorded as done in completed.log in the generation
+            directory are computed. A generation that was not started
+            continues from the state of the random number generator saved
+            by the previous generation. This implies existing=True, and the
+            output directory is created if it does not exist, so that
+            resume=True can also be used to start a run.
+
+        parameter_bundle: bool, optional
+            Whether to pack the parameter files of each generation into a
+            single indexed file, parameters.bundle in the generation
+            directory, instead of writing one file per model to the par/
+            directory, which is slow on parallel filesystems. Models with a
+            run_parameters method are then called with the contents of the
+            parameter file instead of its path (along with the model
+            directory and model name as for model.run), and otherwise the
+            parameter file is written to a temporary file while model.run
+            is called. In serial_file mode, the parameter files are written
+            to the par/ directory just before the models are computed.
+
+        layout: str or object, optional
+            How to arrange the files of each model in the models/, par/, and
+            plots/ directories of each generation. Can be 'flat' (all the
+            files directly in these directories) or 'hashed' (in two levels
+            of sub-directories picked from a hash of the model name), or a
+            layout object such as HashedLayout(levels=..., width=...). The
+            model_dir passed to model.run and fitter.fit_one is the
+            sub-directory for that model, and fitters given the whole models
+            directory should use list_models to find the models instead of
+            listing the files.
+
+        overwrite: bool, optional
+            Whether to delete existing directories that need to be created.
+            By default, an exception is raised if such a directory exists.
+
+        table_format: str or object, optional
+            The format of the parameter and fitting results tables of each
+            generation. Can be 'fits' (using atpy) or 'npy' (numpy
+            structured arrays, which avoids loading atpy), or an object with
+            an extension attribute and read and write methods as in
+            tables.py. Fitters with a run method should write the fitting
+            results in the same format.
+
+        diagnostics: bool or int, optional
+            Whether to make the diagnostic plots (which requires matplotlib),
+            or if an integer N is given, to make them every N generations.
+            The plots, as well as the lineage of the models, are written out
+            in background threads. The lineage of a generation is complete
+            once compute_fits returns, while the plots are only guaranteed
+            to be complete once close returns.
+
+        instrument: bool, optional
+            Whether to record the start time and duration of each stage of
+            each generation, and for each model the time it waited to be
+            run, its run time, its status, the process (and MPI rank) that
+            ran it, and the size of its output (see instrument.py). These
+            are written to the stages and timings tables of each generation,
+            next to the fitting results. With the files pipeline, measuring
+            the size of the output requires listing the directories holding
+            the models of each generation.
+
+        sinks: list, optional
+            Functions that are called with each instrumentation event, given
+            as a dictionary. For example, JSONLinesSink(filename) appends the
+            events to a file. Giving sinks turns on instrument.
+
+        profile: bool, optional
+            Whether to profile the calls to the methods of the model and the
+            fitter with cProfile. The statistics are written to the
+            profiles/ directory, in one file per method and process.
         '''
 
         # Read in parameters
@@ -285,17 +697,37 @@ class Genetic(object):
 
         # Read in configuration file
         self.parameters = {}
+        self._par_names = []
         for line in file(configuration, 'rb'):
             if not line.strip() == "":
                 name, sampling_mode, vmin, vmax = string.split(line)
+                if sampling_mode not in ['linear', 'log']:
+                    raise Exception("Unknown mode: %s" % sampling_mode)
                 self.parameters[name] = {'mode': sampling_mode,
                                          'min': float(vmin),
                                          'max': float(vmax)}
+                self._par_names.append(name)
+
+        # Bounds of the parameters in the space in which they are sampled
+        self._par_log = np.array([self.parameters[name]['mode'] == 'log' for name in self._par_names])
+        self._par_lower = np.array([self.parameters[name]['min'] for name in self._par_names])
+        self._par_upper = np.array([self.parameters[name]['max'] for name in self._par_names])
+        self._par_lower[self._par_log] = np.log10(self._par_lower[self._par_log])
+        self._par_upper[self._par_log] = np.log10(self._par_upper[self._par_log])
 
         # Set genetic parameters
         self._fraction_output = fraction_output
         self._fraction_mutation = fraction_mutation
         self._max_time = max_time
+        self._random = np.random.RandomState(seed)
+        self._archive = None
+
+        if callable(initial_design):
+            self._initial_design = initial_design
+        elif initial_design in designs:
+            self._initial_design = designs[initial_design]
+        else:
+            raise Exception("initial_design should be one of %s" % string.join(sorted(designs.keys()), '/'))
 
         if mode in ['serial', 'serial_file']:
             self._mode = mode
@@ -304,270 +736,590 @@ class Genetic(object):
             if n_cores is not None:
                 raise Exception("Cannot set n_cores in serial mode")
         elif mode == 'mpi':
-            if not mpi_enabled:
+            if not mpi.init():
                 raise Exception("Can't use MPI, mpi4py did not import correctly")
             self._mode = mode
             if n_cores is not None:
                 raise Exception("Cannot set n_cores in mpi mode")
+            self._n_cores = max(mpi.nproc - 1, 1)
         elif mode == 'multiprocessing':
             self._mode = mode
             if n_cores is None:
                 raise Exception("Need to set n_cores in multiprocessing mode")
             self._n_cores = n_cores
+            self._pool = None
+            self._pool_objects = {}
         else:
             raise Exception("mode should be one of serial/mpi/multiprocessing")
 
-        # Create output directory
-        if not existing and (not self._mode == 'mpi' or rank == 0):
-            create_dir(self._models_dir)
+        self._chunk_size = chunk_size
+
+        if pipeline not in ['files', 'memory']:
+            raise Exception("pipeline should be one of files/memory")
+        if pipeline == 'memory' and self._mode == 'serial_file':
+            raise Exception("Cannot use the memory pipeline in serial_file mode")
+        self._pipeline = pipeline
+        self._par_tables = {}
+        self._outputs = {}
+
+        # The cache is only used on rank 0 in MPI mode
+        if cache is None or (self._mode == 'mpi' and mpi.rank > 0):
+            self._cache = None
+        elif isinstance(cache, basestring):
+            self._cache = EvaluationCache(cache)
+        else:
+            self._cache = cache
+        self._cache_namespace = self._pipeline + ':' + hashlib.sha1(string.join(self._template, '')).hexdigest()
+        self._cached_fits = {}
+        self._streamed_fits = {}
+        self._supervised_run = None
+        self._parameter_bundle = parameter_bundle
+        self._bundled_run = None
+        self._compiled_template = None
+
+        if isinstance(layout, basestring):
+            if layout not in layouts:
+                raise Exception("layout should be one of %s" % string.join(sorted(layouts.keys()), '/'))
+            self._layout = layouts[layout]()
+        else:
+            self._layout = layout
 
-    def _generation_dir(self, generation):
-        return self._models_dir + '/g%05i/' % generation
+        self._overwrite = overwrite
 
-    def _parameter_file(self, generation, model_name):
-        return self._parameter_dir(generation) + str(model_name) + '.par'
+        if isinstance(table_format, basestring):
+            if table_format not in table_formats:
+                raise Exception("table_format should be one of %s" % string.join(sorted(table_formats.keys()), '/'))
+            self._tables = table_formats[table_format]()
+        else:
+            self._tables = table_format
 
-    def _model_prefix(self, generation, model_name):
-        return self._model_dir(generation) + str(model_name)
+        if diagnostics is True:
+            self._diagnostics_every = 1
+        else:
+            self._diagnostics_every = int(diagnostics or 0)
 
-    def _parameter_table(self, generation):
-        return self._generation_dir(generation) + 'parameters.fits'
+        # Lineage tables are written before the generation is marked as
+        # complete, while the plots are only waited for by close()
+        self._lineage_writer = DiagnosticsWriter()
+        self._plot_writer = DiagnosticsWriter()
 
-    def _fitting_results_file(self, generation):
-        return self._generation_dir(generation) + 'fitting_output.fits'
+        # Create output directory
+        if not self._mode == 'mpi' or mpi.rank == 0:
+            if resume:
+                if not os.path.exists(self._models_dir):
+                    os.makedirs(self._models_dir)
+            elif not existing:
+                create_dir(self._models_dir, overwrite=self._overwrite)
+
+        self._resume = resume
+        if not self._mode == 'mpi' or mpi.rank == 0:
+            self._manifest = RunManifest(os.path.join(self._models_dir, 'run.json'))
+            if instrument or sinks:
+                self._instrumentation = Instrumentation(sinks)
+            else:
+                self._instrumentation = None
+        else:
+            self._manifest = None
+            self._instrumentation = None
 
-    def _log_file(self, generation):
-        return self._generation_dir(generation) + 'parameters.log'
+        if profile:
+            self._profile_dir = os.path.join(self._models_dir, 'profiles')
+        else:
+            self._profile_dir = None
+        self._profiled_objects = {}
 
-    def _sampling_plot_file(self, generation):
-        return self._generation_dir(generation) + 'sampling.eps'
+    def close(self):
+        '''
+        Shut down the pool of processes used to compute models in
+        multiprocessing mode, and wait for the diagnostics to be written
+        out. The pool is kept from one generation to the next, so this
+        should be called once all generations are done.
+        '''
+        if self._mode == 'multiprocessing':
+            self._close_pool()
+            self._pool_objects = {}
+        if self._cache is not None:
+            self._cache.close()
+            self._cache = None
+        self._lineage_writer.flush()
+        self._plot_writer.flush()
+        if self._instrumentation is not None:
+            self._instrumentation.close()
+
+    def _close_pool(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _get_pool(self, obj, method):
+        '''
+        Return the pool of processes, making sure that the object on which
+        the method specified is called is available in the workers. The pool
+        is only re-created if a different object was used for that method
+        when the pool was created, so the same model object should be passed
+        for all generations.
+        '''
+        if self._pool_objects.get(method) is not obj:
+            self._close_pool()
+            self._pool_objects[method] = obj
+            import multiprocessing
+            self._pool = multiprocessing.Pool(processes=self._n_cores,
+                                 initializer=_init_worker,
+                                 initargs=(self._pool_objects,))
+        return self._pool
+
+    def _map(self, obj, method, args, max_time=None, callback=None):
+        '''
+        Call the method specified of obj for each tuple of arguments in args,
+        either in the current process, using the pool of processes in
+        multiprocessing mode, or using all the ranks in MPI mode, and return
+        the results in the same order.
+
+        In MPI mode, this should be called on all ranks, but args only needs
+        to be specified on rank 0, and the results are only returned on rank
+        0.
+
+        If max_time is set, calls that take longer than max_time seconds are
+        interrupted, and their result is a ModelTimeout instance.
+
+        If callback is set, callback(i, result, timing) is called on rank 0
+        as soon as the result for args[i] is available, where timing is a
+        (queued, start, end, worker, rank) tuple giving the time at which
+        the call was ready to run, the start and end time of the call, and
+        the process ID and MPI rank that made it.
+        '''
 
-    def _model_dir(self, generation):
-        return self._generation_dir(generation) + 'models/'
+        if callback is None:
+            callback = lambda i, result, timing: None
 
-    def _parameter_dir(self, generation):
-        return self._generation_dir(generation) + 'par/'
+        queued = time.time()
 
-    def _plots_dir(self, generation):
-        return self._generation_dir(generation) + 'plots/'
+        if self._mode in ['serial', 'serial_file']:
+            results = []
+            for i in range(len(args)):
+                result, timing = call_timed(getattr(obj, method), args[i], max_time)
+                results.append(result)
+                callback(i, result, (queued,) + timing)
+            return results
 
-    def initialize(self, generation):
-        '''
-        Initialize the directory structure for the generation specified.
-        '''
-        if not self._mode == 'mpi' or rank == 0:
-            create_dir(self._generation_dir(generation))
-            create_dir(self._model_dir(generation))
-            create_dir(self._parameter_dir(generation))
-            create_dir(self._plots_dir(generation))
-        return
+        if self._chunk_size is None:
+            n_tasks = len(args) if mpi.rank == 0 else 0
+            chunk_size = max(1, int(np.ceil(n_tasks / (4. * self._n_cores))))
+        else:
+            chunk_size = self._chunk_size
 
-    def make_par_table(self, generation, validate=lambda x: True):
-        '''
-        Creates a table of models to compute for the generation specified.
+        if self._mode == 'mpi':
 
-        If this is the first generation, then the parameters are sampled in an
-        unbiased way within the ranges specified by the user. Otherwise, this
-        method uses results from previous generations to determine which
-        models to run.
-        '''
-        if not self._mode == 'mpi' or rank == 0:
+            def execute(a):
+                return call_timed(getattr(obj, method), a, max_time)
 
-            print "[genetic] Generation %i: making parameter table" % generation
+            if mpi.rank == 0:
+                results = [None] * len(args)
+                def on_result(i, output):
+                    results[i], timing = output
+                    callback(i, results[i], (queued,) + timing)
+                mpi.master(deque(enumerate(args)), chunk_size, on_result, execute)
+                return results
+            else:
+                mpi.worker(execute)
+                return None
 
-            t = atpy.Table()
+        pool = self._get_pool(obj, method)
 
-            if generation == 1:
+        tasks = [(i, method, args[i], max_time) for i in range(len(args))]
 
-                print "Initializing parameter file for first generation"
+        results = [None] * len(tasks)
+        for i, result, timing in pool.imap_unordered(_call_worker, tasks, chunk_size):
+            results[i] = result
+            callback(i, result, (queued,) + timing)
 
-                # Create model names column
-                t.add_column('model_name', ["g1_" + str(i) for i in range(self.n_models)], dtype='|S30')
+        return results
 
-                # Create empty columns in table
-                for par_name in self.parameters:
-                    t.add_empty_column(par_name, dtype=float)
+    def _generation_dir(self, generation):
+        return self._models_dir + '/g%05i/' % generation
 
-                for i in range(self.n_models):
+    def _parameter_file(self, generation, model_name):
+        return self._parameter_dir(generation) + self._layout.bucket(model_name) + str(model_name) + '.par'
 
-                    for sample in range(n_max_sample):
+    def _model_prefix(self, generation, model_name):
+        return self._model_dir(generation, model_name) + str(model_name)
 
-                        for par_name in self.parameters:
+    def _parameter_table(self, generation):
+        return self._generation_dir(generation) + 'parameters' + self._tables.extension
 
-                            mode = self.parameters[par_name]['mode']
-                            vmin = self.parameters[par_name]['min']
-                            vmax = self.parameters[par_name]['max']
+    def _fitting_results_file(self, generation):
+        return self._generation_dir(generation) + 'fitting_output' + self._tables.extension
 
-                            if mode == "linear":
-                                value = r.uniform(vmin, vmax)
-                            elif mode == "log":
-                                value = 10. ** r.uniform(np.log10(vmin), np.log10(vmax))
-                            else:
-                                raise Exception("Unknown mode: %s" % mode)
+    def _stages_file(self, generation):
+        return self._generation_dir(generation) + 'stages' + self._tables.extension
 
-                            t.data[par_name][i] = value
+    def _timings_file(self, generation):
+        return self._generation_dir(generation) + 'timings' + self._tables.extension
 
-                        if validate(t.data[i]):
-                            break
+    def _lineage_file(self, generation):
+        return self._generation_dir(generation) + 'lineage' + self._tables.extension
 
-                    if sample == n_max_sample - 1:
-                        raise Exception("Could not sample a valid model after {:d} tries".format(n_max_sample))
+    def _sampling_plot_file(self, generation):
+        return self._generation_dir(generation) + 'sampling.eps'
 
-            else:
+    def _model_dir(self, generation, model_name=None):
+        # The directory for the model specified, or for all models
+        if model_name is None:
+            return self._generation_dir(generation) + 'models/'
+        else:
+            return self._generation_dir(generation) + 'models/' + self._layout.bucket(model_name)
 
-                n_output = int(self.n_models * self._fraction_output)
+    def _bundle_file(self, generation):
+        return self._generation_dir(generation) + 'parameters.bundle'
 
-                # Create model names column
-                t.add_column('model_name', ["g%i_%i" % (generation, i) for i in range(n_output)], dtype='|S30')
+    def _parameter_dir(self, generation):
+        return self._generation_dir(generation) + 'par/'
 
-                # Read in previous parameter tables
+    def _plots_dir(self, generation, model_name=None):
+        if model_name is None:
+            return self._generation_dir(generation) + 'plots/'
+        else:
+            return self._generation_dir(generation) + 'plots/' + self._layout.bucket(model_name)
 
-                par_table = atpy.Table(self._parameter_table(1),
-                                       verbose=False)
-                for g in range(2, generation):
-                    par_table.append(atpy.Table(self._parameter_table(g),
-                                     verbose=False))
+    def _completion_log(self, generation):
+        return CompletionLog(self._generation_dir(generation) + 'completed.log')
 
-                model_names = np.array([x.strip() for x in par_table.model_name.tolist()])
+    def next_generation(self):
+        '''
+        Return the first generation that has not been completed according to
+        the record of the run, which is where a resumed run should continue.
+        In MPI mode, this should be called on all ranks.
+        '''
+        generation = None
+        if not self._mode == 'mpi' or mpi.rank == 0:
+            generation = self._manifest.last_completed() + 1
+        if self._mode == 'mpi':
+            generation = mpi.comm.bcast(generation, root=0)
+        return generation
 
-                for column in par_table.names:
-                    if column != 'model_name':
-                        t.add_empty_column(column,
-                                           par_table.columns[column].dtype)
+    def _failures_file(self, generation):
+        return self._generation_dir(generation) + 'failures.txt'
 
-                # Read in fitter results, and sort from best to worst-fit chi^2
+    def _record_failures(self, generation, failures):
+        '''
+        Record the models that failed to compute, given a dictionary with the
+        reason for each model name. These models are excluded from the fitting
+        results when building the history of previous generations.
+        '''
+        if len(failures) == 0:
+            return
+        print "[genetic] Generation %i: %i models failed" % (generation, len(failures))
+        f = file(self._failures_file(generation), 'ab')
+        for model_name in sorted(failures):
+            f.write('%s %s\n' % (model_name, failures[model_name]))
+        f.close()
+
+    def _read_failures(self, generation):
+        if not os.path.exists(self._failures_file(generation)):
+            return set()
+        return set(line.split()[0] for line in file(self._failures_file(generation), 'rb') if line.strip())
+
+    def _history_dir(self):
+        return self._models_dir + '/history/'
+
+    def _load_history(self):
+        if self._archive is None:
+            self._archive = HistoryArchive(self._history_dir())
+        return self._archive
+
+    def _history(self, generation):
+        '''
+        Return the archive of the parameters and fitting results of all the
+        generations before the one specified. Generations that are not yet
+        in the archive (normally only the previous generation, or all of
+        them for a run started before the archive existed) are read in from
+        their parameters.fits and fitting_output.fits files and appended.
+        '''
+        archive = self._load_history()
+        for g in range(1, generation):
+            if g not in archive.generations:
+                par_table = self._tables.read(self._parameter_table(g))
+                chi2_table = self._tables.read(self._fitting_results_file(g))
+                failures = self._read_failures(g)
+                keep = np.array([name.strip() not in failures for name in chi2_table['model_name']], dtype=bool)
+                archive.append_generation(g,
+                                          dict((name, par_table[name]) for name in par_table.dtype.names),
+                                          {'model_name': chi2_table['model_name'][keep],
+                                           'chi2': chi2_table['chi2'][keep]})
+        return archive
+
+    @_stage('initialize')
+    def initialize(self, generation):
+        '''
+        Initialize the directory structure for the generation specified.
+        '''
+        if not self._mode == 'mpi' or mpi.rank == 0:
+            directories = [self._generation_dir(generation)]
+            if self._pipeline == 'files':
+                directories.append(self._model_dir(generation))
+                if not self._parameter_bundle:
+                    directories.append(self._parameter_dir(generation))
+            directories.append(self._plots_dir(generation))
+            if self._resume and self._manifest.started(generation):
+                # Keep what was done before the run was interrupted
+                print "[genetic] Generation %i: resuming" % generation
+                for directory in directories:
+                    if not os.path.exists(directory):
+                        os.mkdir(directory)
+            else:
+                for directory in directories:
+                    create_dir(directory, overwrite=self._overwrite)
+                self._manifest.discard(generation)
+                self._manifest.mark(generation, 'started')
+            self._load_history().discard(generation)
+        return
 
-                chi2_table = atpy.Table(self._fitting_results_file(1),
-                                        verbose=False)
-                for g in range(2, generation):
-                    chi2_table.append(atpy.Table(self._fitting_results_file(g), verbose=False))
+    def _sample_valid(self, data, propose, validate, batch_validate, initial=None):
+        '''
+        Fill in the parameter columns of data, the structured array of a
+        parameter table, with valid models.
+
+        The propose argument should be a function that given an array of row
+        indices returns an array of candidate parameters (in the space in
+        which they are sampled) for these rows. Candidates are drawn for all
+        the rows at once, and then only for the rows that were rejected. With
+        a batch validation function, several candidates are drawn for each
+        rejected row based on the fraction of candidates accepted so far.
+        If specified, the initial array of parameters is used as the first
+        candidates for all the rows instead of calling propose.
+        '''
 
-                chi2_table.sort('chi2')
+        pending = np.arange(len(data))
+        factor = 1
+        tries = 0
 
-                order = np.argsort(chi2_table.chi2)
+        while len(pending) > 0:
 
-                # Truncate the table to the n_models first models
+            if tries >= n_max_sample:
+                raise Exception("Could not sample a valid model after {:d} tries".format(n_max_sample))
 
-                # chi2_table = chi2_table.rows(range(self.n_models))
-                chi2_table = chi2_table.rows(order[: self.n_models])
+            index = np.repeat(pending, factor)
+            if initial is not None and tries == 0:
+                values = initial
+            else:
+                values = propose(index)
 
-                print "Best fit so far: ", chi2_table.data[0]
+            candidates = data[index]
+            for j, par_name in enumerate(self._par_names):
+                if self._par_log[j]:
+                    candidates[par_name] = 10. ** values[:, j]
+                else:
+                    candidates[par_name] = values[:, j]
 
-                selected = []
+            if batch_validate is None:
+                valid = np.array([validate(candidate) for candidate in candidates], dtype=bool)
+            else:
+                valid = np.asarray(batch_validate(candidates), dtype=bool)
 
-                mutations = 0
-                crossovers = 0
+            # Keep the first valid candidate for each row
+            rows, first = np.unique(index[valid], return_index=True)
+            data[rows] = candidates[valid][first]
 
-                logfile = file(self._log_file(generation), 'wb')
+            pending = np.setdiff1d(pending, rows)
+            tries += factor
 
-                for i in range(0, n_output):
+            if batch_validate is not None and len(pending) > 0:
+                acceptance = max(np.mean(valid), 1. / len(valid))
+                factor = int(min(np.ceil(1. / acceptance), n_max_sample - tries, max_oversample))
 
-                    # Select whether to do crossover or mutation
+        return
 
-                    if(r.random() > self._fraction_mutation):
+    @_stage('make_par_table')
+    def make_par_table(self, generation, validate=lambda x: True,
+                       batch_validate=None):
+        '''
+        Creates a table of models to compute for the generation specified.
 
-                        crossovers += 1
+        If this is the first generation, then the parameters are sampled in an
+        unbiased way within the ranges specified by the user. Otherwise, this
+        method uses results from previous generations to determine which
+        models to run.
 
-                        im1, im2 = select(chi2_table.chi2, n=2, k_frac=0.1, p=0.9)
+        The validate argument can be used to pass a function that given a
+        row of the parameter table returns whether the model is valid.
+        Alternatively, batch_validate can be used to pass a function that
+        given an array of rows returns a boolean array indicating which are
+        valid, which is much faster if the validation can be vectorized.
+        Invalid models are re-sampled.
 
-                        m1 = chi2_table.model_name[im1]
-                        m2 = chi2_table.model_name[im2]
+        When resuming a run, the parameter table is not made again if it was
+        already made for this generation, and otherwise the random number
+        generator is restored to its state after the previous generation.
+        '''
+        if not self._mode == 'mpi' or mpi.rank == 0:
+
+            if self._resume and self._manifest.get(generation, 'parameters') and os.path.exists(self._parameter_table(generation)):
+                print "[genetic] Generation %i: parameter table already made" % generation
+                self._set_random_state(self._manifest.get(generation, 'random_state'))
+                return
 
-                        logfile.write('g%s_%i = crossover of %s and %s\n' % (generation, i, m1, m2))
+            if self._resume and self._manifest.latest(generation, 'random_state') is not None:
+                self._set_random_state(self._manifest.latest(generation, 'random_state'))
 
-                        selected.append(im1)
-                        selected.append(im2)
+            print "[genetic] Generation %i: making parameter table" % generation
 
-                        par_m1 = par_table.row(np.char.strip(par_table.model_name) == m1.strip())
-                        par_m2 = par_table.row(np.char.strip(par_table.model_name) == m2.strip())
+            if generation == 1:
 
-                        for sample in range(n_max_sample):
+                print "Initializing parameter file for first generation"
 
-                            for par_name in par_table.names:
+                # Create model names column and empty parameter columns
+                columns = [('model_name', ["g1_" + str(i) for i in range(self.n_models)], '|S30')]
+                for par_name in self._par_names:
+                    columns.append((par_name, np.zeros(self.n_models), float))
+                data = make_table(columns)
 
-                                if par_name != 'model_name':
+                def propose(index):
+                    return self._random.uniform(self._par_lower, self._par_upper,
+                                                (len(index), len(self._par_names)))
 
-                                    par1 = par_m1[par_name]
-                                    par2 = par_m2[par_name]
+                design = self._initial_design(self.n_models, len(self._par_names), self._random)
+                initial = self._par_lower + design * (self._par_upper - self._par_lower)
 
-                                    xi = r.uniform(0., 1.)
+                self._sample_valid(data, propose, validate, batch_validate, initial=initial)
 
-                                    mode = self.parameters[par_name]['mode']
+            else:
 
-                                    if mode == "linear":
-                                        value = par1 * xi + par2 * (1. - xi)
-                                    elif mode == "log":
-                                        value = 10. ** (np.log10(par1) * xi + np.log10(par2) * (1. - xi))
-                                    else:
-                                        raise Exception("Unknown mode: %s" % mode)
+                n_output = int(self.n_models * self._fraction_output)
 
-                                    t.data[par_name][i] = value
+                # Read in previous parameter tables and fitter results
 
-                            if validate(t.data[i]):
-                                break
+                history = self._history(generation)
 
-                        if sample == n_max_sample - 1:
-                            raise Exception("Could not sample a valid model after {:d} tries".format(n_max_sample))
+                par_table = history.parameters
 
-                    else:
+                # Create model names column and empty parameter columns
+                columns = [('model_name', ["g%i_%i" % (generation, i) for i in range(n_output)], '|S30')]
+                for column in par_table.names:
+                    if column != 'model_name':
+                        columns.append((column, np.zeros(n_output), par_table.dtype(column)))
+                data = make_table(columns)
 
-                        mutations += 1
+                # Sort from best to worst-fit chi^2, and truncate to the
+                # n_models first models
 
-                        im1 = select(chi2_table.chi2, n=1, k_frac=0.1, p=0.9)[0]
+                order = np.argsort(history.fitting.column('chi2'), kind='mergesort')
 
-                        m1 = chi2_table.model_name[im1]
+                chi2 = history.fitting.column('chi2')[order[:self.n_models]]
+                chi2_names = history.fitting.column('model_name')[order[:self.n_models]]
 
-                        logfile.write('g%s_%i = mutation of %s\n' % (generation, i, m1))
+                print "Best fit so far: ", chi2_names[0].strip(), chi2[0]
 
-                        selected.append(im1)
+                # Select whether to do crossover or mutation, and run all the
+                # tournaments for the generation at once
 
-                        mutation = r.choice(par_table.names)
+                is_crossover = self._random.random_sample(n_output) > self._fraction_mutation
 
-                        par_m1 = par_table.row(np.char.strip(par_table.model_name) == m1.strip())
+                parents = select_batch(chi2,
+                                       n=np.sum(is_crossover) + n_output,
+                                       k_frac=0.1, p=0.9,
+                                       random_state=self._random)
 
-                        for sample in range(n_max_sample):
+                # Find the rows of the selected models in the parameter table
+                parent_rows = history.rows(chi2_names[parents])
 
-                            for par_name in par_table.names:
+                # Assign the selected models to the children in turn, two for
+                # each crossover and one for each mutation
 
-                                if par_name != 'model_name':
+                n_parents = is_crossover + 1
+                first = np.cumsum(n_parents) - n_parents
+                second = first + is_crossover
 
-                                    value = par_m1[par_name]
+                crossovers = np.sum(is_crossover)
+                mutations = n_output - crossovers
 
-                                    if par_name == mutation:
+                # Choose the parameter to change in each mutation. As one
+                # of the table columns is drawn, including model_name, one in
+                # n_par + 1 mutations leaves the parameters unchanged.
 
-                                        mode = self.parameters[par_name]['mode']
-                                        vmin = self.parameters[par_name]['min']
-                                        vmax = self.parameters[par_name]['max']
+                mutated = self._random.randint(0, len(self._par_names) + 1, n_output)
 
-                                        if mode == "linear":
-                                            value = r.uniform(vmin, vmax)
-                                        elif mode == "log":
-                                            value = 10. ** r.uniform(np.log10(vmin), np.log10(vmax))
-                                        else:
-                                            raise Exception("Unknown mode: %s" % mode)
+                parents1 = history.values(parent_rows[first], self._par_names, self._par_log)
+                parents2 = history.values(parent_rows[second], self._par_names, self._par_log)
 
-                                    t.data[par_name][i] = value
+                def propose(index):
+                    values = np.zeros((len(index), len(self._par_names)))
+                    c = is_crossover[index]
+                    m = ~c
+                    values[c] = crossover(parents1[index[c]], parents2[index[c]],
+                                          random_state=self._random)
+                    values[m] = mutate(parents1[index[m]], mutated[index[m]],
+                                       self._par_lower, self._par_upper,
+                                       random_state=self._random)
+                    return values
 
-                            if validate(t.data[i]):
-                                break
+                self._sample_valid(data, propose, validate, batch_validate)
 
-                        if sample == n_max_sample - 1:
-                            raise Exception("Could not sample a valid model after {:d} tries".format(n_max_sample))
+                # Write out the lineage of the children
 
-                logfile.close()
+                self._write_lineage(generation,
+                                    lineage_table(data['model_name'],
+                                                  np.where(is_crossover, 'crossover', 'mutation'),
+                                                  chi2_names[parents[first]],
+                                                  np.where(is_crossover, chi2_names[parents[second]], '')))
 
                 print "   Mutations  : " + str(mutations)
                 print "   Crossovers : " + str(crossovers)
 
-                fig = mpl.figure()
-                ax = fig.add_subplot(111)
-                ax.hist(selected, 50)
-                fig.savefig(self._sampling_plot_file(generation))
+                if self._diagnostics_every > 0 and generation % self._diagnostics_every == 0:
+                    self._plot_writer.submit(plot_sampling, parents, self._sampling_plot_file(generation))
+
+            self._tables.write(self._parameter_table(generation), data)
 
-            t.write(self._parameter_table(generation), verbose=False)
+            if self._pipeline == 'memory':
+                self._par_tables[generation] = data
+
+            state = self._random.get_state()
+            self._manifest.mark(generation, 'random_state', [state[0], state[1].tolist()] + list(state[2:]))
+            self._manifest.mark(generation, 'parameters')
 
         return
 
+    def _set_random_state(self, state):
+        # Restore the random number generator from a state saved in run.json
+        self._random.set_state((str(state[0]), np.array(state[1], dtype=np.uint32)) + tuple(state[2:]))
+
+    def _write_lineage(self, generation, lineage):
+        self._lineage_writer.submit(self._tables.write, self._lineage_file(generation), lineage)
+
+    def _parameter_rows(self, generation):
+        '''
+        Return the rows of the parameter table for the generation specified
+        as a list of dictionaries, using the table kept in memory by
+        make_par_table if available.
+        '''
+        if generation in self._par_tables:
+            data = self._par_tables.pop(generation)
+        else:
+            data = self._tables.read(self._parameter_table(generation))
+        return [dict(zip(data.dtype.names, row)) for row in data]
+
+    def _write_fitting_results(self, generation, model_names, rows):
+        '''
+        Write out the fitting results for the generation specified, given
+        the model names and a list with a dictionary of results for each
+        model, which should contain at least 'chi2'.
+        '''
+        columns = [('model_name', model_names, '|S30'),
+                   ('chi2', [row['chi2'] for row in rows], float)]
+        if len(rows) > 0:
+            for column in sorted(rows[0].keys()):
+                if column != 'chi2':
+                    columns.append((column, [row[column] for row in rows]))
+        self._tables.write(self._fitting_results_file(generation), make_table(columns))
+
+    @_stage('make_par_indiv')
     def make_par_indiv(self, generation, parser, interpreter=None):
         '''
         For the generation specified, will read in the parameters.fits file
@@ -581,86 +1333,137 @@ class Genetic(object):
         parameter name and a dictionary of parameter values, will determine
         the actual value to use (useful for example if several parameters are
         correlated).
-        '''
-
-        if not self._mode == 'mpi' or rank == 0:
-
-            print "[genetic] Generation %i: making individual parameter files" % generation
-
-            # Read in table and construct dictionary
-            table = atpy.Table(self._parameter_table(generation))
-            par_table = [dict(zip(table.names, table.row(i)))
-                            for i in range(len(table))]
-
-            # Find static parameters
-            static = {}
-            for line in self._template:
-                name, value = parser(line)
-                if value != 'VAR' and value is not None:
-                    static[name] = value
 
-            # Cycle through models and create a parameter file for each
-            for model in par_table:
+        The template is only parsed once, and the files are written in
+        parallel in multiprocessing and mpi modes. If the parameter bundle
+        option is set, the files are rendered in parallel and then packed
+        into a single bundle.
 
-                # Create new parameter file
-                model_name = model['model_name'].strip()
-                f = file(self._parameter_file(generation, model_name), 'wb')
-
-                # Cycle through template lines
-                for line in self._template:
-                    name, value = parser(line)
-                    if value == 'VAR':
-                        if interpreter:
-                            value = interpreter(generation, name, dict(model.items() + static.items()))
-                        else:
-                            value = model[name]
-                        f.write(line.replace('VAR', str(value)))
-                    else:
-                        f.write(line)
+        This does nothing when using the memory pipeline.
+        '''
 
-                f.close()
+        if self._pipeline == 'files':
+
+            models = None
+
+            if not self._mode == 'mpi' or mpi.rank == 0:
+                print "[genetic] Generation %i: making individual parameter files" % generation
+                models = self._parameter_rows(generation)
+
+            template = self._compile_template(parser, interpreter)
+            directory = self._parameter_dir(generation)
+
+            if self._parameter_bundle:
+                if self._mode == 'mpi':
+                    shares = None
+                    if mpi.rank == 0:
+                        shares = [models[i::mpi.nproc] for i in range(mpi.nproc)]
+                    contents = mpi.comm.gather(template.render_many(generation, mpi.comm.scatter(shares, root=0)), root=0)
+                elif self._mode == 'multiprocessing':
+                    n_chunks = max(1, min(len(models), 4 * self._n_cores))
+                    contents = self._map(template, 'render_many', [(generation, models[i::n_chunks])
+                                                                   for i in range(n_chunks)])
+                else:
+                    contents = [template.render_many(generation, models)]
+                if not self._mode == 'mpi' or mpi.rank == 0:
+                    ParameterBundle(self._bundle_file(generation)).write(sum(contents, []))
+            elif self._mode == 'mpi':
+                # Each rank writes an equal share of the files
+                shares = None
+                if mpi.rank == 0:
+                    shares = [models[i::mpi.nproc] for i in range(mpi.nproc)]
+                template.write(directory, generation, mpi.comm.scatter(shares, root=0), self._layout)
+            elif self._mode == 'multiprocessing':
+                n_chunks = max(1, min(len(models), 4 * self._n_cores))
+                self._map(template, 'write', [(directory, generation, models[i::n_chunks], self._layout)
+                                              for i in range(n_chunks)])
+            else:
+                template.write(directory, generation, models, self._layout)
 
         if self._mode == 'mpi':
-            low_cpu_barrier()
+            mpi.low_cpu_barrier()
 
         return
 
-    def compute_models(self, generation, model):
+    def _compile_template(self, parser, interpreter):
+        # Keep the same compiled template from one generation to the next,
+        # so that the pool of processes does not need to be re-created
+        if self._compiled_template is None or \
+           self._compiled_template.parser is not parser or \
+           self._compiled_template.interpreter is not interpreter:
+            self._compiled_template = CompiledTemplate(self._template, parser, interpreter)
+        return self._compiled_template
+
+    @_stage('compute_models')
+    def compute_models(self, generation, model, fitter=None, priority=None):
         '''
         For the generation specified, will compute all the models listed in
-        the par/ directory.
+        the parameter table that have not been computed yet.
 
         The model argument should be used to pass a function that given a
         parameter file and an output model directory will compute the model
         for that input and produce output with the specified prefix.
+
+        If a fitter with a fit_one method is given, fitter.fit_one is called
+        with the model directory and the model name as soon as each model has
+        been computed, and should return the fitting results for the model,
+        in the same form as fitter.evaluate (see compute_fits). In serial,
+        multiprocessing, and mpi modes, the model is fitted by the process
+        that started the child process computing it, once the child is done,
+        and in serial_file mode, in a thread of the main process while other
+        models are running. The results are then written out by compute_fits
+        without calling fitter.run.
+
+        The models are dispatched in the order of the parameter table, or if
+        a priority function is given, in decreasing order of the value it
+        returns when given a row of the parameter table. For example, a
+        function returning an estimate of the run time of each model can be
+        used to start the longest models first.
+
+        With the memory pipeline, the model argument should instead be an
+        object with an evaluate method that given a dictionary of parameter
+        values returns the results for the model (see compute_fits), and the
+        fitter argument is ignored.
         '''
 
         start_dir = os.path.abspath(".")
 
-        if self._mode in ['serial', 'multiprocessing']:
+        model = self._profiled(model)
+        fitter = self._profiled(fitter)
 
-            # Wrapper function to be able to use multiple arguments in map
-            # def run_wrapper(args):
-            #     return model.run(*args)
+        streaming = hasattr(fitter, 'fit_one')
 
-            run_wrapper = RunWrapper(model.run)
+        if self._pipeline == 'memory':
+
+            self._evaluate_models(generation, model, priority)
+
+        elif self._mode in ['serial', 'multiprocessing']:
+
+            log, models = self._models_to_compute(generation, priority)
 
             # Define arguments
-            models = []
-            for par_file in glob.glob(os.path.join(self._parameter_dir(generation), '*.par')):
-                model_name = string.split(os.path.basename(par_file), '.')[0]
-                models.append((par_file, self._model_dir(generation), model_name))
+            models = [(par_file, self._model_dir(generation, model_name), model_name)
+                      for par_file, model_name in models]
+
+            def done(i, result, timing):
+                self._record_run(generation, log, models[i][2], result, timing, streaming)
+
+            # Each model is computed in a child process, which is killed
+            # along with any processes it started if it runs for too long
+            if self._parameter_bundle:
+                model = self._bundled(model)
+            run = self._supervised(model, start_dir, fitter)
 
             # Run the models using map
             if self._mode == 'serial':
                 print "[genetic] Generation %i: computing models in serial mode" % generation
-                map(run_wrapper, models)
             else:
                 print "[genetic] Generation %i: computing models using multiprocessing" % generation
-                p = mp.Pool(processes=self._n_cores)
-                p.map(run_wrapper, models)
+            self._map(run, 'run_and_fit' if streaming else 'run', models, callback=done)
+
+            self._record_completed(generation, log)
 
-        elif ['serial_file']:
+        elif self._mode == 'serial_file':
 
             # This mode allows the model running function to be called via the
             # command-line instead of via a direct function call. The reason
@@ -672,124 +1475,613 @@ class Genetic(object):
             if not isinstance(model, basestring):
                 raise ValueError("model should be the path to a script")
 
-            # Loop over models and start up the process for each model
-            processes = []
-
-            for par_file in glob.glob(os.path.join(self._parameter_dir(generation), '*.par')):
-
-                while len(processes) >= self.submit_limit:
-                    sleep(self.submit_delay)
-                    remove = []
-                    for i in range(len(processes)):
-                        p = processes[i]
-                        if p.poll() is not None:
-                            remove.append(i)
-                    for i in remove[::-1]:
-                        processes.pop(i)
-                    print "[genetic] %i models running" % len(processes)
-
-                model_name = string.split(os.path.basename(par_file), '.')[0]
-                p = subprocess.Popen([model, par_file, self._model_dir(generation), model_name])
-                processes.append(p)
-                print "Submitting %s" % model_name
-                sleep(self.submit_delay)
-
-            while len(processes) > 0:
-                sleep(self.submit_delay)
-                remove = []
-                for i in range(len(processes)):
-                    p = processes[i]
-                    if p.poll() is not None:
-                        remove.append(i)
-                for i in remove[::-1]:
-                    processes.pop(i)
-                print "[genetic] %i models running" % len(processes)
+            print "[genetic] Generation %i: computing models in serial_file mode" % generation
+
+            log, models = self._models_to_compute(generation, priority)
+
+            # The scripts need parameter files
+            if self._parameter_bundle:
+                bundle = ParameterBundle(self._bundle_file(generation))
+                if not os.path.exists(self._parameter_dir(generation)):
+                    os.mkdir(self._parameter_dir(generation))
+                self._layout.make_dirs(self._parameter_dir(generation), [model_name for bundle_file, model_name in models])
+                models = [(bundle.materialize(model_name, os.path.dirname(self._parameter_file(generation, model_name))), model_name)
+                          for bundle_file, model_name in models]
+
+            # Start up a process for each model, keeping at most submit_limit
+            # running at any time
+            jobs = [Job(model_name, [model, par_file, self._model_dir(generation, model_name), model_name])
+                    for par_file, model_name in models]
+
+            # Models that succeeded are fitted in a separate thread, so
+            # that new models can be started in the meantime
+            to_fit = Queue.Queue()
+            errors = []
+
+            def fit():
+                job = to_fit.get()
+                while job is not None:
+                    try:
+                        log.record(job.name, 'ok', fitter.fit_one(self._model_dir(generation, job.name), job.name))
+                    except Exception, e:
+                        traceback.print_exc()
+                        errors.append(e)
+                    job = to_fit.get()
+
+            def done(job):
+                if job.timed_out:
+                    status = 'timeout'
+                elif job.returncode != 0:
+                    status = 'exit_code_%i' % job.returncode
+                else:
+                    status = 'ok'
+                if status != 'ok':
+                    log.record(job.name, status)
+                elif streaming:
+                    to_fit.put(job)
+                else:
+                    log.record(job.name, 'ok')
+                self._record_model(generation, job.name, status,
+                                   (queued, offset + job.start_time, offset + job.end_time, job.pid, 0))
+
+            if streaming:
+                thread = threading.Thread(target=fit)
+                thread.start()
+
+            # The scheduler measures times with a monotonic clock
+            queued = time.time()
+            offset = queued - clock()
+
+            try:
+                scheduler = ProcessScheduler(limit=self.submit_limit, delay=self.submit_delay,
+                                             max_time=self._max_time)
+                scheduler.run(jobs, on_finish=done)
+            finally:
+                if streaming:
+                    to_fit.put(None)
+                    thread.join()
+
+            if len(errors) > 0:
+                raise errors[0]
+
+            self._record_completed(generation, log)
 
             print "[genetic] models done, exiting"
 
         else:
 
-            low_cpu_barrier()
+            mpi.low_cpu_barrier()
 
-            if rank == 0:
+            models = None
+            done = None
 
-                print "[genetic] Generation %i: computing models with %i processes (using MPI)" % (generation, nproc)
+            if mpi.rank == 0:
 
-                for par_file in glob.glob(os.path.join(self._parameter_dir(generation), '*.par')):
+                print "[genetic] Generation %i: computing models with %i processes (using MPI)" % (generation, mpi.nproc)
 
-                    print "[mpi] rank 0 waiting for communications"
+                log, models = self._models_to_compute(generation, priority)
 
-                    while True:
-                        status = MPI.Status()
-                        comm.Iprobe(source=MPI.ANY_SOURCE, tag=1, status=status)
-                        if status.source > 0:
-                            break
-                        time.sleep(delta)
+                models = [(par_file, self._model_dir(generation, model_name), model_name)
+                          for par_file, model_name in models]
 
-                    data = comm.recv(source=status.source, tag=1)
-                    if data['status'] == 'ready':
-                        print "[mpi] rank 0 received ready from rank %i" % data['source']
-                        print "[mpi] rank 0 sending model %s to rank %i" % (par_file, data['source'])
-                        comm.send({'model': par_file}, dest=data['source'], tag=2)
-                    else:
-                        raise Exception("Got unexpected status: %s" % data['status'])
+                def done(i, result, timing):
+                    self._record_run(generation, log, models[i][2], result, timing, streaming)
 
-                stopped = np.zeros(nproc, dtype=bool)
+            if self._parameter_bundle:
+                model = self._bundled(model)
 
-                while True:
+            run = self._supervised(model, start_dir, fitter)
+            self._map(run, 'run_and_fit' if streaming else 'run', models, callback=done)
 
-                    if np.all(stopped[1:]):
-                        break
+            if mpi.rank == 0:
+                self._record_completed(generation, log)
+
+        if not self._mode == 'mpi' or mpi.rank == 0:
+            self._models_done(generation)
+
+        if streaming and self._pipeline == 'files':
+            if not self._mode == 'mpi' or mpi.rank == 0:
+                self._collect_streamed_fits(generation, fitter)
+            else:
+                self._streamed_fits[generation] = None
+
+        if self._mode == 'mpi':
+            mpi.low_cpu_barrier()
+
+        return
+
+    def _collect_streamed_fits(self, generation, fitter):
+        '''
+        Keep the fitting results computed by fitter.fit_one for compute_fits.
+        Models that were computed without being fitted (for example before
+        resuming a run) are fitted now.
+        '''
+        log = self._completion_log(generation)
+        fits = {}
+        for model_name, (status, fit) in log.read().items():
+            if status == 'ok':
+                if fit is None:
+                    fit = fitter.fit_one(self._model_dir(generation, model_name), model_name)
+                    log.record(model_name, 'ok', fit)
+                fits[model_name] = fit
+        self._streamed_fits[generation] = fits
+
+    def _supervised(self, model, start_dir, fitter):
+        # Keep the same wrapper from one generation to the next, so that the
+        # pool of processes does not need to be re-created
+        run = self._supervised_run
+        if run is None or run.model is not model or run.fitter is not fitter or run.start_dir != start_dir:
+            self._supervised_run = SupervisedRun(model, self._max_time, start_dir, fitter=fitter,
+                                                 profile_dir=self._profile_dir)
+        return self._supervised_run
+
+    def _record_run(self, generation, log, model_name, result, timing, streaming):
+        '''
+        Record the result of SupervisedRun.run, or of run_and_fit if
+        streaming, for the model specified in the completion log and with
+        the instrumentation.
+        '''
+        if streaming:
+            result, fit = result
+        else:
+            fit = None
+        if isinstance(result, ModelTimeout):
+            status = 'timeout'
+        elif result != 0:
+            status = 'exit_code_%i' % result
+        else:
+            status = 'ok'
+        log.record(model_name, status, fit if status == 'ok' else None)
+        self._record_model(generation, model_name, status, timing)
+
+    def _bundled(self, model):
+        if self._bundled_run is None or self._bundled_run.model is not model:
+            self._bundled_run = BundledRun(model)
+        return self._bundled_run
+
+    def _models_to_compute(self, generation, priority=None):
+        '''
+        Return the completion log for the generation specified, and the
+        parameter file (or parameter bundle) and name of each model that
+        still has to be computed, in the order given by the parameter table
+        and the priority function, excluding the models that are already
+        recorded as done in the log and the models found in the cache.
+        '''
+
+        log = self._completion_log(generation)
+        completed = log.read()
+        if len(completed) > 0:
+            print "[genetic] Generation %i: %i models already done" % (generation, len(completed))
+
+        rows = self._parameter_rows(generation)
+
+        cached = self._lookup_cached_fits(generation, rows)
 
-                    print "[mpi] rank 0 waiting for communications"
+        models = []
+        for i in self._dispatch_order(rows, priority):
+            model_name = rows[i]['model_name'].strip()
+            if model_name not in cached and model_name not in completed:
+                if self._parameter_bundle:
+                    models.append((self._bundle_file(generation), model_name))
+                else:
+                    models.append((self._parameter_file(generation, model_name), model_name))
 
-                    while True:
-                        status = MPI.Status()
-                        comm.Iprobe(source=MPI.ANY_SOURCE, tag=1, status=status)
-                        if status.source > 0:
-                            break
-                        time.sleep(delta)
+        model_names = [model_name for par_file, model_name in models]
+        self._layout.make_dirs(self._model_dir(generation), model_names)
+        self._layout.make_dirs(self._plots_dir(generation), model_names)
 
-                    data = comm.recv(source=status.source, tag=1)
-                    if data['status'] == 'ready':
-                        print "[mpi] rank 0 received ready from rank %i" % data['source']
-                        print "[mpi] rank 0 sending stop to rank %i" % data['source']
-                        comm.send({'model': 'stop'}, dest=data['source'], tag=2)
-                        stopped[data['source']] = True
-                    else:
-                        raise Exception("Got unexpected status: %s" % data['status'])
+        return log, models
 
+    def _dispatch_order(self, rows, priority):
+        '''
+        Return the order in which to compute the models given the rows of
+        the parameter table: in decreasing order of priority if a priority
+        function is given, and otherwise in the order of the table.
+        '''
+        if priority is None:
+            return range(len(rows))
+        else:
+            # The sort is stable, so models with equal priority are kept in
+            # the order of the table
+            return sorted(range(len(rows)), key=lambda i: priority(rows[i]), reverse=True)
+
+    def _record_completed(self, generation, log):
+        '''
+        Record the failed models in the completion log that are not yet
+        recorded in the failures file, and with the files pipeline, write
+        out the index of the models computed for list_models.
+        '''
+        completed = log.read()
+        recorded = self._read_failures(generation)
+        self._record_failures(generation, dict((model_name, status) for model_name, (status, output)
+                                               in completed.items()
+                                               if status != 'ok' and model_name not in recorded))
+        if self._pipeline == 'files':
+            write_index(self._model_dir(generation), self._layout,
+                        sorted(model_name for model_name, (status, output) in completed.items() if status == 'ok'))
+
+    def _record_model(self, generation, model_name, status, timing, output=None):
+        '''
+        Record a model computed with the instrumentation, given its status,
+        the timing tuple passed to the callback of _map, and in the memory
+        pipeline its output.
+        '''
+        if self._instrumentation is not None:
+            self._instrumentation.model(generation, model_name, status, timing,
+                                        output_size=None if output is None else output_size(output))
+
+    def _output_sizes(self, generation, model_names):
+        '''
+        Return the total size of the files written by each of the models of
+        the generation specified, counting the files and directories in the
+        directory of each model (given by the layout) whose names start with
+        the model name. Only the directories holding these models are
+        listed, rather than the whole models/ directory.
+        '''
+        buckets = {}
+        for model_name in model_names:
+            buckets.setdefault(self._model_dir(generation, model_name), set()).add(model_name)
+        sizes = {}
+        for directory, names in buckets.items():
+            for filename in os.listdir(directory):
+                match = _model_name.match(filename)
+                if not match or match.group() not in names:
+                    continue
+                path = os.path.join(directory, filename)
+                if os.path.isdir(path):
+                    size = sum(os.path.getsize(os.path.join(sub_path, sub_file))
+                               for sub_path, sub_dirs, sub_files in os.walk(path)
+                               for sub_file in sub_files)
+                else:
+                    size = os.path.getsize(path)
+                sizes[match.group()] = sizes.get(match.group(), 0) + size
+        return sizes
+
+    def _models_done(self, generation):
+        # Pass the models computed for the generation specified to the
+        # instrumentation sinks, with the size of their output files in the
+        # files pipeline
+        if self._instrumentation is not None and self._instrumentation.has_models(generation):
+            if self._pipeline == 'files':
+                self._instrumentation.models_done(generation, self._output_sizes(
+                    generation, self._instrumentation.model_names(generation)))
             else:
+                self._instrumentation.models_done(generation)
+
+    def _write_timings(self, generation):
+        '''
+        Write out the stages of the generation specified and the models
+        computed to tables next to the fitting results.
+        '''
+
+        if self._instrumentation is None:
+            return
+
+        stages, models = self._instrumentation.pop(generation)
+
+        if len(stages) > 0:
+            self._tables.write(self._stages_file(generation),
+                               make_table([('stage', [event['stage'] for event in stages], '|S20'),
+                                           ('start', [event['start'] for event in stages], float),
+                                           ('duration', [event['duration'] for event in stages], float)]))
+
+        if len(models) > 0:
+            columns = [('model_name', [event['model_name'] for event in models], '|S30'),
+                       ('status', [event['status'] for event in models], '|S30')]
+            for name in ['queue_wait', 'run_time', 'start', 'end']:
+                columns.append((name, [event[name] for event in models], float))
+            for name in ['worker', 'rank', 'output_size']:
+                columns.append((name, [-1 if event[name] is None else event[name] for event in models], int))
+            self._tables.write(self._timings_file(generation), make_table(columns))
+
+    def _profiled(self, obj):
+        '''
+        Return the model or fitter given wrapped so that its methods are
+        profiled, if profiling is enabled. The same wrapper is returned for
+        the same object, so that the pool of processes is kept.
+        '''
+        if self._profile_dir is None or obj is None or isinstance(obj, basestring):
+            return obj
+        if id(obj) not in self._profiled_objects or self._profiled_objects[id(obj)].obj is not obj:
+            self._profiled_objects[id(obj)] = Profiled(obj, self._profile_dir)
+        return self._profiled_objects[id(obj)]
+
+    def _evaluate_models(self, generation, model, priority=None):
+        '''
+        Compute the models for the generation specified by passing the
+        parameters of each model directly to model.evaluate, and keep the
+        results in memory for compute_fits. The output of each model is also
+        kept in the completion log, so that it is not computed again if the
+        run is resumed.
+        '''
 
-                while True:
+        args = None
+        done = None
+
+        if not self._mode == 'mpi' or mpi.rank == 0:
+
+            rows = self._parameter_rows(generation)
+            model_names = [row['model_name'].strip() for row in rows]
+            parameters = [dict((name, float(row[name])) for name in self._par_names) for row in rows]
+
+            log = self._completion_log(generation)
+            completed = log.read()
+            if len(completed) > 0:
+                print "[genetic] Generation %i: %i models already done" % (generation, len(completed))
+
+            cached = {}
+            if self._cache is not None:
+                cached = self._cache.get_many(parameters, namespace=self._cache_namespace)
+                print "[genetic] Generation %i: %i models found in cache" % (generation, len(cached))
+
+            run = [i for i in self._dispatch_order(rows, priority)
+                   if i not in cached and model_names[i] not in completed]
+            args = [(parameters[i],) for i in run]
+
+            def done(j, output, timing):
+                if isinstance(output, ModelTimeout):
+                    log.record(model_names[run[j]], 'timeout')
+                    self._record_model(generation, model_names[run[j]], 'timeout', timing)
+                else:
+                    log.record(model_names[run[j]], 'ok', output)
+                    self._record_model(generation, model_names[run[j]], 'ok', timing, output)
+
+        if self._mode == 'serial':
+            print "[genetic] Generation %i: evaluating models in serial mode" % generation
+            results = self._map(model, 'evaluate', args, max_time=self._max_time, callback=done)
+        elif self._mode == 'multiprocessing':
+            print "[genetic] Generation %i: evaluating models using multiprocessing" % generation
+            results = self._map(model, 'evaluate', args, max_time=self._max_time, callback=done)
+        else:
+            if mpi.rank == 0:
+                print "[genetic] Generation %i: evaluating models with %i processes (using MPI)" % (generation, mpi.nproc)
+            results = self._map(model, 'evaluate', args, max_time=self._max_time, callback=done)
+
+        if not self._mode == 'mpi' or mpi.rank == 0:
+
+            if self._cache is not None:
+                new = [j for j in range(len(run)) if not isinstance(results[j], ModelTimeout)]
+                self._cache.put_many([parameters[run[j]] for j in new], [results[j] for j in new],
+                                     namespace=self._cache_namespace)
+
+            self._record_completed(generation, log)
+
+            for j in range(len(run)):
+                if isinstance(results[j], ModelTimeout):
+                    completed[model_names[run[j]]] = ('timeout', None)
+                else:
+                    completed[model_names[run[j]]] = ('ok', results[j])
+
+            outputs = []
+            for i in range(len(model_names)):
+                if i in cached:
+                    outputs.append((model_names[i], cached[i]))
+                elif completed[model_names[i]][0] == 'ok':
+                    outputs.append((model_names[i], completed[model_names[i]][1]))
+            self._outputs[generation] = outputs
+
+    def _lookup_cached_fits(self, generation, rows):
+        '''
+        Look up the models of the generation specified in the cache, given
+        the rows of the parameter table, and keep the fitting results found
+        for compute_fits. Returns the set of names of the models found, which
+        do not need to be computed.
+        '''
+
+        if self._cache is None:
+            return set()
+        parameters = [dict((name, float(row[name])) for name in self._par_names) for row in rows]
+        found = self._cache.get_many(parameters, namespace=self._cache_namespace)
+
+        print "[genetic] Generation %i: %i models found in cache" % (generation, len(found))
+
+        self._cached_fits[generation] = dict((rows[i]['model_name'].strip(), found[i]) for i in found)
+
+        return set(self._cached_fits[generation])
+
+    def _merge_cached_fits(self, generation):
+        '''
+        Add the fitting results of the models found in the cache to the
+        results written by the fitter, and add the results of the models
+        that were computed to the cache.
+        '''
+
+        cached = self._cached_fits.pop(generation, {})
+
+        model_names, results = [], []
+        if os.path.exists(self._fitting_results_file(generation)):
+            data = self._tables.read(self._fitting_results_file(generation))
+            for values in data:
+                row = dict(zip(data.dtype.names, values))
+                model_names.append(row.pop('model_name').strip())
+                results.append(row)
+
+        # Cache the results of the models that were computed successfully
+        failures = self._read_failures(generation)
+        parameters = dict((row['model_name'].strip(), dict((name, float(row[name])) for name in self._par_names))
+                          for row in self._parameter_rows(generation))
+        new = [i for i in range(len(model_names))
+               if model_names[i] not in failures and model_names[i] in parameters]
+        self._cache.put_many([parameters[model_names[i]] for i in new], [results[i] for i in new],
+                             namespace=self._cache_namespace)
+
+        if len(cached) > 0:
+            for model_name in sorted(cached):
+                model_names.append(model_name)
+                results.append(cached[model_name])
+            self._write_fitting_results(generation, model_names, results)
+
+    def _fit_output(self, fitter, model_name, output):
+        '''
+        Return the fitting results for the output of model.evaluate, as a
+        dictionary containing at least 'chi2'.
+        '''
+        if fitter is not None:
+            output = fitter.evaluate(model_name, output)
+        if isinstance(output, dict):
+            return output
+        else:
+            return {'chi2': output}
 
-                    print "[mpi] rank %i is ready" % rank
-                    comm.send({'status': 'ready', 'source': rank}, dest=0, tag=1)
-                    data = comm.recv(source=0, tag=2)
+    def run_steady_state(self, n_evaluations, model, fitter=None,
+                         validate=lambda x: True, batch_validate=None):
+        '''
+        Run the genetic algorithm without barriers between generations,
+        using the memory pipeline.
+
+        The first generation is sampled as in make_par_table. Then, whenever
+        a model is done and its result is fitted, a new child is bred from
+        the n_models best models so far (using the same tournament selection
+        and crossover/mutation as make_par_table) and computed straight
+        away, so that no process is left waiting for the slowest model of a
+        generation. This continues until n_evaluations models in total have
+        been computed.
+
+        Children are numbered in groups of n_models * fraction_output, which
+        are written out as generations (with the same files as
+        make_par_table and compute_fits) once all their models are done.
+
+        The model, fitter, validate, and batch_validate arguments are the
+        same as for compute_models, compute_fits, and make_par_table. In MPI
+        mode, this should be called on all ranks.
+        '''
 
-                    if data['model'] == 'stop':
-                        print "[mpi] rank %i has finished running models" % rank
+        if self._pipeline != 'memory':
+            raise Exception("The steady-state mode requires the memory pipeline")
+
+        model = self._profiled(model)
+        fitter = self._profiled(fitter)
+
+        if self._mode == 'mpi' and mpi.rank > 0:
+            mpi.worker(lambda a: call_timed(model.evaluate, a, self._max_time))
+            return
+
+        self.initialize(1)
+        self.make_par_table(1, validate=validate, batch_validate=batch_validate)
+
+        state = _SteadyState(self, n_evaluations, fitter, validate, batch_validate)
+
+        print "[genetic] Running steady-state genetic algorithm in %s mode" % self._mode
+
+        if self._mode == 'serial':
+
+            task = state.next_task()
+            while task is not None:
+                model_name, parameters = task
+                output, timing = call_timed(model.evaluate, (parameters,), self._max_time)
+                state.add_result(model_name, output, timing)
+                task = state.next_task()
+            state.check_stalled()
+
+        elif self._mode == 'multiprocessing':
+
+            pool = self._get_pool(model, 'evaluate')
+            results = Queue.Queue()
+            running = 0
+
+            while True:
+
+                # Keep two models per process queued or running. Until enough
+                # models are done to select parents, no children can be bred,
+                # so we wait for more results.
+                while running < 2 * self._n_cores:
+                    task = state.next_task()
+                    if task is None:
                         break
+                    model_name, parameters = task
+                    pool.apply_async(_call_worker_safe,
+                                     ((model_name, 'evaluate', (parameters,), self._max_time),),
+                                     callback=results.put)
+                    running += 1
 
-                    par_file = data['model']
+                if running == 0:
+                    state.check_stalled()
+                    break
 
-                    print "[mpi] rank %i running model: %s" % (rank, par_file)
+                model_name, output, timing = results.get()
+                running -= 1
 
-                    # Prepare model name and output filename
-                    model_name = string.split(os.path.basename(par_file), '.')[0]
+                if isinstance(output, Exception) and not isinstance(output, ModelTimeout):
+                    raise output
 
-                    # Prepare thread
-                    os.chdir(start_dir)
-                    p = mp.Process(target=model.run, args=(par_file, self._model_dir(generation), model_name))
-                    p.start()
-                    wait_with_timeout(p, self._max_time)
+                state.add_result(model_name, output, timing)
 
-        if self._mode == 'mpi':
-            low_cpu_barrier()
+        else:
+
+            # Tasks are (model_name, arguments) tuples, as for _map
+            tasks = deque()
+            while len(state.initial) > 0:
+                model_name, parameters = state.next_task()
+                tasks.append((model_name, (parameters,)))
+
+            # Each result frees a process, which is given a new task. If no
+            # child can be bred yet, the request is held back by mpi.master
+            # and the task is owed until a later result allows breeding.
+            owed = [0]
+
+            def on_result(model_name, result):
+                output, timing = result
+                state.add_result(model_name, output, timing)
+                owed[0] += 1
+                while owed[0] > 0:
+                    task = state.next_task()
+                    if task is None:
+                        break
+                    model_name, parameters = task
+                    tasks.append((model_name, (parameters,)))
+                    owed[0] -= 1
+
+            mpi.master(tasks, 1, on_result,
+                       lambda a: call_timed(model.evaluate, a, self._max_time))
+
+            state.check_stalled()
+
+        self._lineage_writer.flush()
 
         return
 
-    def compute_fits(self, generation, fitter):
+    def _fit_subsets(self, generation, fitter):
+        '''
+        Fit the models of the generation specified by calling
+        fitter.run_subset on subsets of the models, spread over the
+        processes used to compute the models, and write out the merged
+        results. Models that failed or were found in the cache are skipped.
+        '''
+
+        args = None
+
+        if not self._mode == 'mpi' or mpi.rank == 0:
+
+            failures = self._read_failures(generation)
+            cached = self._cached_fits.get(generation, {})
+            model_names = [row['model_name'].strip() for row in self._parameter_rows(generation)]
+            model_names = [name for name in model_names if name not in failures and name not in cached]
+
+            # Split the models into about four subsets per process
+            if self._mode in ['serial', 'serial_file']:
+                n_subsets = 1
+            else:
+                n_subsets = 4 * self._n_cores
+            n_subsets = max(1, min(n_subsets, len(model_names)))
+            subsets = [list(subset) for subset in np.array_split(np.array(model_names, dtype=object), n_subsets)]
+
+            print "[genetic] Generation %i: fitting and plotting %i subsets of models" % (generation, len(subsets))
+
+            args = [(self._model_dir(generation), subset, self._plots_dir(generation)) for subset in subsets]
+
+        results = self._map(fitter, 'run_subset', args)
+
+        if not self._mode == 'mpi' or mpi.rank == 0:
+            model_names, rows = [], []
+            for a, result in zip(args, results):
+                for model_name, output in zip(a[1], result):
+                    if output is not None:
+                        model_names.append(model_name)
+                        rows.append(self._fit_output(None, model_name, output))
+            self._write_fitting_results(generation, model_names, rows)
+
+    @_stage('compute_fits', last=True)
+    def compute_fits(self, generation, fitter=None):
         '''
         For the generation specified, will compute the fit of all the models.
 
@@ -797,10 +2089,56 @@ class Genetic(object):
         directory containing all the models, an output file, and a directory
         that can be used for plots, will output a table containing at least
         two columns named 'model_name' and 'chi2'.
+
+        With the memory pipeline, the output of model.evaluate for each
+        model should be either the chi^2 value or a dictionary containing
+        'chi2' and optionally other scalar results, which are written out as
+        additional columns. If a fitter is given, its evaluate method is
+        called with the model name and the output of model.evaluate, and
+        should return the chi^2 value or dictionary instead.
+
+        With the files pipeline, if the fitter has a run_subset method, the
+        models are instead fitted in parallel, using the same processes as
+        compute_models. run_subset is called with the directory containing
+        the models, a list of model names, and the directory for plots, and
+        should return a list with the fitting results for each model, in the
+        same form as fitter.evaluate above, or None for models that could
+        not be fitted. The results are then merged into a single table. In
+        MPI mode, this should be called on all ranks.
+
+        If the models were fitted by fitter.fit_one while being computed
+        (see compute_models), the fitting results are written out directly.
+
+        If a cache is used with the files pipeline, the fitting results of
+        the models found in the cache are added to the table written by the
+        fitter.
         '''
-        if not self._mode == 'mpi' or rank == 0:
+        fitter = self._profiled(fitter)
+        if self._pipeline == 'memory':
+            if not self._mode == 'mpi' or mpi.rank == 0:
+                print "[genetic] Generation %i: fitting" % generation
+                model_names, rows = [], []
+                for model_name, output in self._outputs.pop(generation):
+                    model_names.append(model_name)
+                    rows.append(self._fit_output(fitter, model_name, output))
+                self._write_fitting_results(generation, model_names, rows)
+        elif generation in self._streamed_fits:
+            fits = self._streamed_fits.pop(generation)
+            if not self._mode == 'mpi' or mpi.rank == 0:
+                print "[genetic] Generation %i: writing fitting results" % generation
+                model_names = sorted(fits)
+                self._write_fitting_results(generation, model_names,
+                                            [self._fit_output(None, model_name, fits[model_name]) for model_name in model_names])
+        elif hasattr(fitter, 'run_subset'):
+            self._fit_subsets(generation, fitter)
+        elif not self._mode == 'mpi' or mpi.rank == 0:
             print "[genetic] Generation %i: fitting and plotting" % generation
             fitter.run(self._model_dir(generation), self._fitting_results_file(generation), self._plots_dir(generation))
+        if self._pipeline == 'files' and self._cache is not None:
+            self._merge_cached_fits(generation)
+        if not self._mode == 'mpi' or mpi.rank == 0:
+            self._lineage_writer.flush()
+            self._manifest.mark(generation, 'complete')
         if self._mode == 'mpi':
-            low_cpu_barrier()
+            mpi.low_cpu_barrier()
         return
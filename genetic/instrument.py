@@ -0,0 +1,204 @@
+# Instrumentation of runs. The time taken by each stage of each generation,
+# and for each model the time spent waiting to be run, the run time, the
+# status, the process that ran it, and the size of its output, are recorded
+# as events (dictionaries) that are passed to sinks and written out as
+# tables for each generation.
+
+import os
+import json
+import time
+import shutil
+import pstats
+import cProfile
+import cPickle as pickle
+from contextlib import contextmanager
+
+
+def output_size(output):
+    '''
+    Return the size in bytes of the output of model.evaluate once pickled.
+    '''
+    return len(pickle.dumps(output, pickle.HIGHEST_PROTOCOL))
+
+
+class JSONLinesSink(object):
+    '''
+    A sink that appends each event to a file, as one line of JSON.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = None
+
+    def __call__(self, event):
+        if self._file is None:
+            self._file = open(self.filename, 'ab')
+        self._file.write(json.dumps(event) + '\n')
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class Instrumentation(object):
+    '''
+    Records the stages of each generation and the models computed. Each
+    sink is a function that is called with each event: stage events are
+    passed on as soon as the stage is done, and model events once all the
+    models of a generation are done (so that the size of their output can
+    be measured).
+
+    Times are given as seconds since the epoch. The queue wait of a model is
+    the time between the model being ready to run and its start, which is
+    measured on different hosts in MPI mode, so it is only accurate if the
+    clocks of the hosts are synchronized.
+    '''
+
+    def __init__(self, sinks=None):
+        self.sinks = list(sinks) if sinks else []
+        self._stages = {}
+        self._models = {}
+
+    def _emit(self, event):
+        for sink in self.sinks:
+            sink(event)
+
+    @contextmanager
+    def stage(self, generation, name):
+        start = time.time()
+        yield
+        event = {'event': 'stage', 'generation': generation, 'stage': name,
+                 'start': start, 'duration': time.time() - start}
+        self._stages.setdefault(generation, []).append(event)
+        self._emit(event)
+
+    def model(self, generation, model_name, status, timing, output_size=None):
+        '''
+        Record a model, given its status and a (queued, start, end, worker,
+        rank) tuple, where queued is the time at which the model was ready
+        to run.
+        '''
+        queued, start, end, worker, rank = timing
+        self._models.setdefault(generation, []).append(
+            {'event': 'model', 'generation': generation, 'model_name': model_name,
+             'status': status, 'queue_wait': start - queued, 'run_time': end - start,
+             'start': start, 'end': end, 'worker': worker, 'rank': rank,
+             'output_size': output_size})
+
+    def has_models(self, generation):
+        return len(self._models.get(generation, [])) > 0
+
+    def model_names(self, generation):
+        return [event['model_name'] for event in self._models.get(generation, [])]
+
+    def models_done(self, generation, output_sizes=None):
+        '''
+        Pass the models recorded for the generation specified to the sinks,
+        setting the size of their output from the dictionary given if any.
+        '''
+        for event in self._models.get(generation, []):
+            if output_sizes is not None:
+                event['output_size'] = output_sizes.get(event['model_name'], 0)
+            self._emit(event)
+
+    def pop(self, generation):
+        '''
+        Return and forget the stage and model events recorded for the
+        generation specified.
+        '''
+        return self._stages.pop(generation, []), self._models.pop(generation, [])
+
+    def close(self):
+        for sink in self.sinks:
+            if hasattr(sink, 'close'):
+                sink.close()
+
+
+# Profiles used by Profiled in this process, indexed by file name
+_profiles = {}
+
+# Directory to which Profiled writes its statistics if this is a child
+# process forked to run a single model (see run_profiled_child)
+_child_directory = None
+
+
+def _make_dir(directory):
+    if not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+
+def run_profiled_child(directory, function, *args):
+    '''
+    Call function(*args) in a child process forked to run a single model,
+    with the statistics of Profiled written to files named
+    <class>.<method>.prof in the directory given, rather than to files for
+    this process. The process that forked the child then adds them to its
+    own statistics with merge_profiles.
+    '''
+    global _child_directory
+    _child_directory = directory
+    return function(*args)
+
+
+def merge_profiles(child_directory, directory):
+    '''
+    Add the statistics written by a child process with run_profiled_child
+    to those of this process, written to the directory specified, and
+    remove the child directory.
+    '''
+    try:
+        for name in os.listdir(child_directory):
+            child_file = os.path.join(child_directory, name)
+            filename = os.path.join(directory, '%s.%i.prof' % (name[:-len('.prof')], os.getpid()))
+            if filename in _profiles:
+                _profiles[filename].add(child_file)
+            else:
+                _profiles[filename] = pstats.Stats(child_file)
+            _make_dir(directory)
+            _profiles[filename].dump_stats(filename)
+    finally:
+        shutil.rmtree(child_directory, ignore_errors=True)
+
+
+class Profiled(object):
+    '''
+    Wrapper around a model or fitter that runs each call to its methods
+    under cProfile. The statistics for each method of each class are
+    accumulated in each process, and written to the directory specified
+    after each call, to files named <class>.<method>.<pid>.prof that can be
+    read with pstats. Calls made in the child processes forked to run each
+    model are accumulated in the process that forked them instead.
+    '''
+
+    def __init__(self, obj, directory):
+        self.obj = obj
+        self.directory = directory
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name in ['obj', 'directory']:
+            raise AttributeError(name)
+        attribute = getattr(self.obj, name)
+        if not callable(attribute):
+            return attribute
+        return lambda *args, **kwargs: self._call(name, attribute, args, kwargs)
+
+    def _call(self, name, function, args, kwargs):
+        if _child_directory is None:
+            directory = self.directory
+            filename = os.path.join(directory, '%s.%s.%i.prof' % (type(self.obj).__name__, name, os.getpid()))
+        else:
+            directory = _child_directory
+            filename = os.path.join(directory, '%s.%s.prof' % (type(self.obj).__name__, name))
+        if filename not in _profiles:
+            _profiles[filename] = cProfile.Profile()
+        try:
+            return _profiles[filename].runcall(function, *args, **kwargs)
+        finally:
+            _make_dir(directory)
+            _profiles[filename].dump_stats(filename)
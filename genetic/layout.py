@@ -0,0 +1,82 @@
+# Layouts of the per-model files in the models/, par/ and plots/ directories
+# of each generation. Each layout gives the sub-directory (relative to these
+# directories, and either empty or ending with a slash) in which the files
+# for a given model are placed.
+
+import os
+import json
+import hashlib
+
+
+class FlatLayout(object):
+    '''
+    All the files directly in the models/, par/ and plots/ directories.
+    '''
+
+    def bucket(self, model_name):
+        return ''
+
+    def make_dirs(self, directory, model_names):
+        pass
+
+
+class HashedLayout(object):
+    '''
+    The files spread over levels of sub-directories, each named after width
+    hexadecimal digits of a hash of the model name, so that each directory
+    holds a manageable number of entries. The default gives 256 buckets in
+    two levels (e.g. models/3/f/).
+    '''
+
+    def __init__(self, levels=2, width=1):
+        self.levels = levels
+        self.width = width
+
+    def bucket(self, model_name):
+        digest = hashlib.md5(model_name).hexdigest()
+        return ''.join(digest[i * self.width:(i + 1) * self.width] + '/' for i in range(self.levels))
+
+    def make_dirs(self, directory, model_names):
+        '''
+        Create the sub-directories of the directory specified needed for
+        the models given.
+        '''
+        for bucket in set(self.bucket(model_name) for model_name in model_names):
+            if not os.path.exists(directory + bucket):
+                try:
+                    os.makedirs(directory + bucket)
+                except OSError:
+                    # Other processes may be creating the same directories
+                    if not os.path.isdir(directory + bucket):
+                        raise
+
+
+layouts = {'flat': FlatLayout,
+           'hashed': HashedLayout}
+
+
+def _index_file(models_dir):
+    return os.path.join(models_dir, 'models.index')
+
+
+def write_index(models_dir, layout, model_names):
+    '''
+    Record the models computed in the models directory specified, so that
+    they can be listed with list_models without scanning the directory.
+    '''
+    models = [[model_name, layout.bucket(model_name)] for model_name in model_names]
+    f = open(_index_file(models_dir) + '.tmp', 'wb')
+    json.dump(models, f)
+    f.close()
+    os.rename(_index_file(models_dir) + '.tmp', _index_file(models_dir))
+
+
+def list_models(models_dir):
+    '''
+    Return a list of (model_name, model_dir) tuples giving the directory in
+    which each model computed in the models directory specified placed its
+    output. This should be used by fitters instead of listing the files in
+    the models directory.
+    '''
+    return [(str(model_name), os.path.join(models_dir, bucket))
+            for model_name, bucket in json.load(open(_index_file(models_dir), 'rb'))]
@@ -0,0 +1,162 @@
+# MPI support. mpi4py is only imported by init(), when MPI mode is used, so
+# that the ranks and processes that do not use MPI do not pay for loading
+# and initializing it. Until then, the process is treated as rank 0 of 1.
+
+import time
+import cPickle as pickle
+from collections import deque
+
+enabled = None
+MPI = None
+comm = None
+rank = 0
+nproc = 1
+
+delta = 0.1
+
+# Maximum size of a batch of tasks once pickled, in bytes. Batches are cut
+# short when they would exceed this (but hold at least one task), so that
+# the messages sent to the workers stay small however many tasks there are.
+batch_bytes = 1 << 15
+
+
+def init():
+    '''
+    Import mpi4py and set up the communicator if this was not done
+    already, and return whether MPI is available.
+    '''
+    global enabled, MPI, comm, rank, nproc
+    if enabled is None:
+        try:
+            from mpi4py import MPI
+            comm = MPI.COMM_WORLD
+            rank = comm.Get_rank()
+            nproc = comm.Get_size()
+            enabled = True
+        except ImportError:
+            enabled = False
+    return enabled
+
+
+def low_cpu_barrier():
+
+    if rank == 0:
+
+        for dest in range(1, nproc):
+            print "[mpi] rank 0 sending exit to rank %i" % dest
+            comm.send({'model': 'exit'}, dest=dest, tag=3)
+
+    else:
+
+        while True:
+            status = MPI.Status()
+            comm.Iprobe(source=0, tag=3, status=status)
+            if status.source == 0:
+                break
+            time.sleep(delta)
+
+        data = comm.recv(source=0, tag=3)
+
+    comm.barrier()
+
+
+# MPI task scheduler. Rank 0 sends batches of tasks to the other ranks, which
+# send back the results of each batch together with a request for a new
+# batch. Each worker keeps two requests outstanding, so that its next batch
+# is sent while it runs the current one. Batches are sent without blocking
+# rank 0, and received with blocking receives (which find the size of the
+# message first), so there is no polling delay between tasks and no limit
+# on the size of a batch.
+
+def _next_batch(tasks, batch_size):
+    # Take up to batch_size tasks from the deque, stopping early if the
+    # batch would be larger than batch_bytes once pickled
+    batch = [tasks.popleft()]
+    size = len(pickle.dumps(batch[0], pickle.HIGHEST_PROTOCOL))
+    while len(batch) < batch_size and len(tasks) > 0:
+        size += len(pickle.dumps(tasks[0], pickle.HIGHEST_PROTOCOL))
+        if size > batch_bytes:
+            break
+        batch.append(tasks.popleft())
+    return batch
+
+
+def master(tasks, batch_size, on_result, execute):
+    '''
+    Send the tasks, a deque of (task_id, task) tuples, to the other ranks
+    in batches of up to batch_size tasks (and up to batch_bytes bytes once
+    pickled), and call on_result(task_id, result)
+    for each result received. on_result can append new tasks to the deque.
+    Returns once all tasks are done and the workers have stopped. If there
+    are no other ranks, the tasks are run on rank 0 with execute(task).
+    '''
+
+    if nproc == 1:
+        while len(tasks) > 0:
+            task_id, task = tasks.popleft()
+            on_result(task_id, execute(task))
+        return
+
+    waiting = deque()
+    sending = []
+    in_flight = 0
+    stopped = 0
+
+    while stopped < nproc - 1:
+
+        status = MPI.Status()
+        message, results = comm.recv(source=MPI.ANY_SOURCE, tag=1, status=status)
+
+        if message == 'done':
+            stopped += 1
+            continue
+
+        for task_id, result in results:
+            in_flight -= 1
+            on_result(task_id, result)
+
+        waiting.append(status.Get_source())
+
+        # Requests are served in the order they were received. If there are
+        # no tasks left but some are still running, requests are held back in
+        # case on_result adds tasks when the results come in.
+        while len(waiting) > 0:
+            if len(tasks) > 0:
+                batch = _next_batch(tasks, batch_size)
+                in_flight += len(batch)
+                sending.append(comm.isend(batch, dest=waiting.popleft(), tag=2))
+            elif in_flight == 0:
+                sending.append(comm.isend(None, dest=waiting.popleft(), tag=2))
+            else:
+                break
+
+        sending = [request for request in sending if not request.test()[0]]
+
+    MPI.Request.waitall(sending)
+
+
+def worker(execute):
+    '''
+    Receive batches of tasks from rank 0 and run each task with
+    execute(task), until rank 0 sends None.
+    '''
+
+    comm.send(('ready', []), dest=0, tag=1)
+    comm.send(('ready', []), dest=0, tag=1)
+    outstanding = 2
+
+    batch = comm.recv(source=0, tag=2)
+    outstanding -= 1
+
+    while batch is not None:
+        results = [(task_id, execute(task)) for task_id, task in batch]
+        comm.send(('ready', results), dest=0, tag=1)
+        outstanding += 1
+        batch = comm.recv(source=0, tag=2)
+        outstanding -= 1
+
+    # The remaining requests are all answered with None
+    for i in range(outstanding):
+        comm.recv(source=0, tag=2)
+
+    comm.send(('done', []), dest=0, tag=1)
@@ -0,0 +1,308 @@
+import os
+import sys
+import time
+import fcntl
+import errno
+import select
+import signal
+import traceback
+from collections import deque
+
+# Monotonic clock for measuring intervals. In Python 2, os.times()[4] is the
+# elapsed real time since a fixed point in the past, which unlike time.time()
+# does not jump if the system clock is changed.
+clock = getattr(time, 'monotonic', lambda: os.times()[4])
+
+
+def _set_cloexec(fd, cloexec=True):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    if cloexec:
+        fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+    else:
+        fcntl.fcntl(fd, fcntl.F_SETFD, flags & ~fcntl.FD_CLOEXEC)
+
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+def _ignore(signum, frame):
+    pass
+
+
+class _ChildWatcher(object):
+    '''
+    A pipe that becomes readable when a child process exits. A handler is
+    installed for SIGCHLD, and the pipe is passed to signal.set_wakeup_fd,
+    so that a byte is written to it whenever the signal is received. This
+    only works in the main thread: elsewhere, fileno() returns None and the
+    scheduler checks the children every interval seconds instead.
+    '''
+
+    interval = 0.1
+
+    def __init__(self):
+        self._read_fd = None
+        self._write_fd = None
+        try:
+            previous_fd = signal.set_wakeup_fd(-1)
+        except ValueError:
+            return
+        read_fd, write_fd = os.pipe()
+        for fd in read_fd, write_fd:
+            _set_cloexec(fd)
+            _set_nonblocking(fd)
+        self._read_fd, self._write_fd = read_fd, write_fd
+        self._previous_fd = previous_fd
+        self._previous_handler = signal.signal(signal.SIGCHLD, _ignore)
+        signal.siginterrupt(signal.SIGCHLD, False)
+        signal.set_wakeup_fd(write_fd)
+
+    def fileno(self):
+        return self._read_fd
+
+    def drain(self):
+        if self._read_fd is None:
+            return
+        try:
+            while os.read(self._read_fd, 4096):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def reset_child(self):
+        # Called in forked children, which should not write to the pipe
+        if self._read_fd is None:
+            return
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+
+    def close(self):
+        if self._read_fd is None:
+            return
+        signal.set_wakeup_fd(self._previous_fd)
+        if self._previous_handler is None:
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        else:
+            signal.signal(signal.SIGCHLD, self._previous_handler)
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+        self._read_fd = self._write_fd = None
+
+
+class Job(object):
+    '''
+    A job to run in a child process. If function is not specified, args is
+    the command to run, given as a list of arguments. Otherwise, the child
+    process is forked and calls function(*args).
+
+    Once the job has run, returncode is set to the exit code of the child,
+    or to minus the signal number if the child was killed by a signal, and
+    timed_out is set to whether the job was killed for exceeding the
+    maximum run time.
+    '''
+
+    def __init__(self, name, args, function=None):
+        self.name = name
+        self.args = args
+        self.function = function
+        self.pid = None
+        self.process = None
+        self.returncode = None
+        self.timed_out = False
+        self.start_time = None
+        self.end_time = None
+
+
+class ProcessScheduler(object):
+    '''
+    Run jobs as child processes, with at most limit jobs running at any
+    time and at least delay seconds between the start of consecutive jobs.
+    A new job is started as soon as a running job finishes. If max_time is
+    set, jobs running for longer than max_time seconds are killed.
+
+    A job is finished when its child process exits, whether or not it left
+    processes running in the background. The scheduler blocks until it
+    receives SIGCHLD, with a timeout set by the next job start or the next
+    deadline, so that it uses no CPU while waiting. It then checks each of
+    its children with waitpid(pid, WNOHANG), so that it does not reap
+    processes that it did not start.
+
+    Each child is started in its own process group, so that on timeout the
+    child and any processes it started are killed with a single signal.
+
+    If verbose is set, the start of each job and the number of jobs still
+    running are printed as the jobs progress. Jobs that fail or time out
+    are reported in any case.
+    '''
+
+    def __init__(self, limit=float('inf'), delay=0., max_time=None, verbose=True):
+        self.limit = limit
+        self.delay = delay
+        self.max_time = max_time
+        self.verbose = verbose
+
+    def _start(self, job, watcher):
+
+        if job.function is None:
+
+            import subprocess
+
+            job.process = subprocess.Popen(job.args, preexec_fn=os.setpgrp)
+            job.pid = job.process.pid
+
+        else:
+
+            sys.stdout.flush()
+            sys.stderr.flush()
+
+            job.pid = os.fork()
+
+            if job.pid == 0:
+                code = 1
+                try:
+                    os.setpgid(0, 0)
+                    watcher.reset_child()
+                    job.function(*job.args)
+                    code = 0
+                except SystemExit, e:
+                    code = 0 if e.code is None else e.code
+                except:
+                    traceback.print_exc()
+                finally:
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    os._exit(code)
+
+            # Also set the process group from the parent, in case the
+            # child is killed before it gets to do it
+            try:
+                os.setpgid(job.pid, job.pid)
+            except OSError:
+                pass
+
+        job.start_time = clock()
+
+    def _reap(self, job, block=False):
+        # Set the return code of the job and return True if it has exited,
+        # otherwise return False
+        if job.process is not None:
+            job.returncode = job.process.wait() if block else job.process.poll()
+            if job.returncode is None:
+                return False
+        else:
+            while True:
+                try:
+                    pid, status = os.waitpid(job.pid, 0 if block else os.WNOHANG)
+                    break
+                except OSError, e:
+                    if e.errno != errno.EINTR:
+                        raise
+            if pid == 0:
+                return False
+            if os.WIFSIGNALED(status):
+                job.returncode = -os.WTERMSIG(status)
+            else:
+                job.returncode = os.WEXITSTATUS(status)
+        job.end_time = clock()
+        return True
+
+    def _kill(self, job):
+        try:
+            os.killpg(job.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def _wait(self, watcher, timeout):
+        # Wait until a child exits or the timeout (in seconds, or None to
+        # block) expires
+        if watcher.fileno() is None:
+            if timeout is None or timeout > watcher.interval:
+                timeout = watcher.interval
+            time.sleep(max(0., timeout))
+            return
+        if timeout is not None:
+            timeout = max(0., timeout)
+        try:
+            select.select([watcher.fileno()], [], [], timeout)
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+        watcher.drain()
+
+    def run(self, jobs, on_finish=None):
+        '''
+        Run all the jobs and wait for them to finish. If on_finish is set,
+        on_finish(job) is called as soon as each job has finished.
+        '''
+
+        pending = deque(jobs)
+        running = []
+        last_start = None
+
+        watcher = _ChildWatcher()
+
+        try:
+
+            while len(pending) > 0 or len(running) > 0:
+
+                # Start jobs while there are free slots and the delay since
+                # the last job has expired
+                timeout = None
+                while len(pending) > 0 and len(running) < self.limit:
+                    now = clock()
+                    if last_start is not None and now < last_start + self.delay:
+                        timeout = last_start + self.delay - now
+                        break
+                    job = pending.popleft()
+                    if self.verbose:
+                        print "Submitting %s" % job.name
+                    self._start(job, watcher)
+                    running.append(job)
+                    last_start = job.start_time
+
+                if len(running) == 0:
+                    time.sleep(timeout)
+                    continue
+
+                # Wait until a job finishes, the next job can be started, or
+                # the next job reaches the maximum run time
+                if self.max_time is not None:
+                    deadline = min(job.start_time for job in running) + self.max_time
+                    if timeout is None:
+                        timeout = deadline - clock()
+                    else:
+                        timeout = min(timeout, deadline - clock())
+
+                self._wait(watcher, timeout)
+
+                finished = [job for job in running if self._reap(job)]
+
+                if self.max_time is not None:
+                    now = clock()
+                    for job in running:
+                        if job not in finished and now > job.start_time + self.max_time:
+                            print "[genetic] %s has exceeded %i seconds, terminating" % (job.name, self.max_time)
+                            self._kill(job)
+                            self._reap(job, block=True)
+                            job.timed_out = True
+                            finished.append(job)
+
+                for job in finished:
+                    running.remove(job)
+                    if job.returncode != 0 and not job.timed_out:
+                        print "[genetic] %s exited with code %i" % (job.name, job.returncode)
+                    if on_finish is not None:
+                        on_finish(job)
+
+                if self.verbose:
+                    print "[genetic] %i models running" % len(running)
+
+        finally:
+            watcher.close()
+
+        return jobs
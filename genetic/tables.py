@@ -0,0 +1,72 @@
+# Formats for the parameter and fitting results tables of each generation.
+# Each format reads a table into a numpy structured array, and writes out a
+# structured array, so that the rest of the package does not depend on the
+# library used for the files. The library for a format is only imported when
+# a table is read or written in that format.
+
+import os
+
+import numpy as np
+
+
+class FitsFormat(object):
+    '''
+    FITS tables, read and written with atpy.
+    '''
+
+    extension = '.fits'
+
+    def read(self, filename):
+        import atpy
+        return atpy.Table(filename, verbose=False).data
+
+    def write(self, filename, data):
+        import atpy
+        t = atpy.Table()
+        for name in data.dtype.names:
+            t.add_column(name, data[name])
+        if os.path.exists(filename):
+            os.remove(filename)
+        t.write(filename, verbose=False)
+
+
+class NumpyFormat(object):
+    '''
+    Structured arrays in the numpy .npy format, which needs no other library.
+    '''
+
+    extension = '.npy'
+
+    def read(self, filename):
+        return np.load(filename)
+
+    def write(self, filename, data):
+        f = open(filename, 'wb')
+        np.save(f, data)
+        f.close()
+
+
+table_formats = {'fits': FitsFormat,
+                 'npy': NumpyFormat}
+
+
+def make_table(columns):
+    '''
+    Return a structured array given a list of (name, values) or (name,
+    values, dtype) tuples, one for each column.
+    '''
+
+    arrays = []
+    for column in columns:
+        if len(column) == 3:
+            arrays.append((column[0], np.asarray(column[1], dtype=column[2])))
+        else:
+            arrays.append((column[0], np.asarray(column[1])))
+
+    n_rows = len(arrays[0][1])
+
+    data = np.zeros(n_rows, dtype=[(name, values.dtype) for name, values in arrays])
+    for name, values in arrays:
+        data[name] = values
+
+    return data
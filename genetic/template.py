@@ -0,0 +1,90 @@
+
+class CompiledTemplate(object):
+    '''
+    A parameter file template parsed once into static text and variable
+    slots, so that parameter files can be rendered without calling the
+    parser for every line of every model.
+
+    The parser should be a function that given a line from the template
+    returns the name of the parameter and its value, where a value of 'VAR'
+    indicates a parameter that varies from model to model, and the optional
+    interpreter a function that given the generation, a parameter name, and
+    a dictionary of parameter values, returns the value to use (see
+    Genetic.make_par_indiv).
+    '''
+
+    def __init__(self, lines, parser, interpreter=None):
+
+        self.parser = parser
+        self.interpreter = interpreter
+
+        # Values of the static parameters, which are passed to the
+        # interpreter along with the values for each model
+        self.static = {}
+
+        # The template is split into pieces of static text, each followed by
+        # a slot holding the name of the parameter to insert, or None after
+        # the last piece. Each occurrence of VAR in a variable line is a slot.
+        self._pieces = []
+        self._slots = []
+
+        text = ''
+        for line in lines:
+            name, value = parser(line)
+            if value == 'VAR':
+                parts = line.split('VAR')
+                for part in parts[:-1]:
+                    self._pieces.append(text + part)
+                    self._slots.append(name)
+                    text = ''
+                text += parts[-1]
+            else:
+                if value is not None:
+                    self.static[name] = value
+                text += line
+
+        self._pieces.append(text)
+        self._slots.append(None)
+
+    def render(self, generation, model):
+        '''
+        Return the parameter file for the model specified, given as a
+        dictionary of parameter values.
+        '''
+
+        if self.interpreter:
+            context = dict(model)
+            context.update(self.static)
+            values = {}
+            for name in self._slots[:-1]:
+                if name not in values:
+                    values[name] = str(self.interpreter(generation, name, context))
+        else:
+            values = dict((name, str(model[name])) for name in self._slots[:-1])
+
+        output = []
+        for piece, name in zip(self._pieces, self._slots):
+            output.append(piece)
+            if name is not None:
+                output.append(values[name])
+
+        return ''.join(output)
+
+    def render_many(self, generation, models):
+        '''
+        Return a list of (model_name, contents) tuples for the models in the
+        list given.
+        '''
+        return [(str(model['model_name']).strip(), self.render(generation, model)) for model in models]
+
+    def write(self, directory, generation, models, layout):
+        '''
+        Write out a parameter file named after each model in the list given
+        to the directory specified, arranged according to the layout given
+        (see layout.py).
+        '''
+        layout.make_dirs(directory, [str(model['model_name']).strip() for model in models])
+        for model_name, contents in self.render_many(generation, models):
+            f = open(directory + layout.bucket(model_name) + model_name + '.par', 'wb')
+            f.write(contents)
+            f.close()